@@ -0,0 +1,133 @@
+"""
+Measure how many single-transfer transactions per second
+`transactions.create_transaction` can commit.
+
+Builds a fresh database from the migrations in a temporary directory,
+funds a set of accounts, then makes random small transfers between them,
+each in its own transaction. The connection is opened the same way as
+the bot's, with the pragmas from data/database.json. Run from the
+repository root:
+
+    python -m benchmarks.transfers [--transfers N] [--synchronous MODE]
+
+To get a baseline to compare against, check out the earlier commit in a
+separate worktree and run this copy of the script against it. The worktree
+must be the working directory and on the path, so that its package and
+migrations are the ones measured:
+
+    git worktree add ../bobux-baseline <commit>
+    cd ../bobux-baseline
+    PYTHONPATH=. python ../bobux-economy/benchmarks/transfers.py
+
+Trees from before `bobux_economy.database` existed are opened with
+SQLite's default pragmas, plus --synchronous if it is given.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import dataclasses
+import io
+import logging
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from typing import Optional
+
+import aiosqlite
+import yoyo
+
+from bobux_economy import transactions
+from bobux_economy.bobux import Account, Bobux
+
+try:
+    from bobux_economy import database
+except ImportError:
+    # Baseline trees from before the database module.
+    database = None
+
+GUILD_ID = 1
+
+
+def create_database(path: str):
+    backend = yoyo.get_backend(f"sqlite:///{path}")
+    migrations = yoyo.read_migrations("migrations")
+    # yoyo prints the results of any statement that returns rows.
+    with backend.lock(), contextlib.redirect_stdout(io.StringIO()):
+        backend.apply_migrations(backend.to_apply(migrations))
+
+
+async def connect(path: str, settings_path: str, synchronous: Optional[str]) -> aiosqlite.Connection:
+    if database is None:
+        db_connection = await aiosqlite.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+        db_connection.row_factory = sqlite3.Row
+        if synchronous is not None:
+            await db_connection.execute(f"PRAGMA synchronous = {synchronous}")
+        return db_connection
+
+    settings = database.load_settings(settings_path)
+    if synchronous is not None:
+        settings = dataclasses.replace(settings, synchronous=synchronous)
+    return await database.connect_writer(path, settings)
+
+
+async def run_once(
+    path: str, settings_path: str, accounts: int, transfers: int, synchronous: Optional[str], seed: int
+) -> float:
+    db_connection = await connect(path, settings_path, synchronous)
+    try:
+        members = [Account(user_id, GUILD_ID) for user_id in range(accounts)]
+        for member in members:
+            await transactions.create_transaction(db_connection, None, member, Bobux(1000))
+
+        rng = random.Random(seed)
+        started_at = time.perf_counter()
+        for _ in range(transfers):
+            source, destination = rng.sample(members, 2)
+            await transactions.create_transaction(
+                db_connection, source, destination, Bobux(1, spare_change=True)
+            )
+        elapsed = time.perf_counter() - started_at
+    finally:
+        await db_connection.close()
+
+    return transfers / elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--accounts", type=int, default=100)
+    parser.add_argument("--transfers", type=int, default=3000)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument(
+        "--synchronous",
+        choices=["OFF", "NORMAL", "FULL", "EXTRA"],
+        help="PRAGMA synchronous to use instead of the one in the settings file",
+    )
+    parser.add_argument(
+        "--settings",
+        default="data/database.json",
+        help="database settings file to read the pragmas from",
+    )
+    args = parser.parse_args()
+
+    # Every transaction is logged at INFO.
+    logging.disable(logging.INFO)
+
+    rates = []
+    for run in range(args.runs):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "bench.db")
+            create_database(path)
+            rate = await run_once(path, args.settings, args.accounts, args.transfers, args.synchronous, seed=run)
+        print(f"Run {run + 1}: {rate:.0f} transfers/s")
+        rates.append(rate)
+
+    print(f"Median of {args.runs}: {statistics.median(rates):.0f} transfers/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,15 +1,15 @@
 import asyncio
 from contextlib import suppress
 import logging
-import sqlite3
 import sys
 from typing import List
 
-import aiosqlite
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import yoyo
 
+from bobux_economy import database, economy, webhooks
 from bobux_economy.bot import BobuxEconomyBot
+from bobux_economy.config import guild_config
 
 
 async def main():
@@ -24,18 +24,34 @@ async def main():
     with yoyo_backend.lock():
         yoyo_backend.apply_migrations(yoyo_backend.to_apply(yoyo_migrations))
 
-    async with aiosqlite.connect(
-        "data/bobux.db", detect_types=sqlite3.PARSE_DECLTYPES
-    ) as db_connection:
-        # This will not affect existing code since sqlite3.Row objects
-        # support the same operations as tuples.
-        db_connection.row_factory = sqlite3.Row
+    # Writes go through a single connection, while read-only queries
+    # are spread over a pool of reader connections.
+    # Pragmas and the reader pool size can be overridden from a file.
+    db_settings = database.load_settings("data/database.json")
+    db_connection = await database.connect_writer("data/bobux.db", db_settings)
+    db_readers = database.ReaderPool("data/bobux.db", db_settings)
+    try:
+        # Without any readers, read_cursor falls back to the writer.
+        # Attaching an empty pool would make every read wait forever.
+        if db_settings.reader_pool_size > 0:
+            await db_readers.open()
+            database.attach_readers(db_connection, db_readers)
+
+        # Load data that is checked on every message or vote.
+        await guild_config.load_caches(db_connection)
+        await webhooks.load(db_connection)
+
+        # Fill in or repair the balance histograms before anything reads
+        # them.
+        await economy.recompute(db_connection)
 
         # Initialize the scheduler.
         scheduler = AsyncIOScheduler()
 
         async def start_scheduler():
-            scheduler.start()
+            # on_ready is dispatched again after every reconnect.
+            if not scheduler.running:
+                scheduler.start()
 
         # Load list of test guilds from a file.
         test_guilds: List[int]
@@ -62,7 +78,15 @@ async def main():
         with open("data/token.txt", "r") as token_file:
             token = token_file.read()
 
-        await bot.start(token)
+        try:
+            await bot.start(token)
+        finally:
+            # Don't lose the vote channel checkpoints seen since the last
+            # periodic flush.
+            await bot.vote_checkpoints.flush()
+    finally:
+        await db_readers.close()
+        await db_connection.close()
 
 
 if __name__ == "__main__":
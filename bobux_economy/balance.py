@@ -1,4 +1,3 @@
-import dataclasses
 import math
 from typing import Tuple
 from typing_extensions import deprecated
@@ -15,7 +14,7 @@ async def get(
     db_connection: aiosqlite.Connection, member: disnake.Member
 ) -> Tuple[int, bool]:
     balance = await Account.from_member(member).get_balance(db_connection)
-    return dataclasses.astuple(balance)
+    return balance.amount, balance.spare_change
 
 
 @deprecated("Use transactions.create_transaction(...) instead.")
@@ -0,0 +1,115 @@
+"""
+An in-memory copy of recently used account balances.
+
+Balances are written through the cache after every committed change, so
+reads outside of a transaction never need to touch the database for an
+account that is already cached.
+"""
+
+from collections import OrderedDict
+from typing import Iterable, Optional, Tuple
+
+from bobux_economy import metrics
+
+# The maximum number of balances kept in memory.
+DEFAULT_MAX_SIZE = 8192
+
+hits = metrics.counter(
+    "balance_cache.hits", "Balance reads answered without a database query."
+)
+misses = metrics.counter(
+    "balance_cache.misses", "Balance reads that had to query the database."
+)
+
+
+class BalanceCache:
+    """
+    A bounded LRU of balances in half-bobux, keyed by user and guild ID.
+
+    Values must only be written after the change they reflect has been
+    committed. Fills from reads are checked against a generation number,
+    so a read that raced with a committed write can't overwrite the newer
+    value with an older one.
+    """
+
+    max_size: int
+    generation: int
+    _balances: "OrderedDict[Tuple[int, int], int]"
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.generation = 0
+        self._balances = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._balances)
+
+    def get(self, key: Tuple[int, int]) -> Optional[int]:
+        balance = self._balances.get(key)
+        if balance is None:
+            misses.increment()
+            return None
+
+        hits.increment()
+        self._balances.move_to_end(key)
+        return balance
+
+    def put(self, key: Tuple[int, int], balance: int):
+        """
+        Store a committed balance.
+
+        Parameters
+        ----------
+        key:     The user and guild ID of the account.
+        balance: The balance of the account, in half-bobux.
+        """
+
+        self.generation += 1
+        self._store(key, balance)
+
+    def invalidate(self, keys: Iterable[Tuple[int, int]]):
+        """
+        Forget committed balances that changed without their new values
+        being known.
+
+        Parameters
+        ----------
+        keys: The user and guild IDs of the accounts.
+        """
+
+        self.generation += 1
+        for key in keys:
+            self._balances.pop(key, None)
+
+    def fill(self, key: Tuple[int, int], balance: int, generation: int):
+        """
+        Store a balance that was read from the database, unless anything
+        was written to the cache since the read started.
+
+        Parameters
+        ----------
+        key:        The user and guild ID of the account.
+        balance:    The balance that was read, in half-bobux.
+        generation: The value of `generation` from before the read.
+        """
+
+        if generation == self.generation:
+            self._store(key, balance)
+
+    def _store(self, key: Tuple[int, int], balance: int):
+        self._balances[key] = balance
+        self._balances.move_to_end(key)
+        while len(self._balances) > self.max_size:
+            self._balances.popitem(last=False)
+
+
+balances = BalanceCache()
+
+metrics.gauge(
+    "balance_cache.size", "Balances currently held in memory.", lambda: len(balances)
+)
+metrics.gauge(
+    "balance_cache.hit_ratio",
+    "Fraction of balance reads answered from memory.",
+    lambda: hits.value / max(hits.value + misses.value, 1),
+)
@@ -1,24 +1,61 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
+import functools
 from typing import ClassVar, Type, TypeVar
 import aiosqlite
 
 import disnake
 
+from bobux_economy import balance_cache, database, utils
+
 A = TypeVar("A", bound="Account")
-B = TypeVar("B", bound="Bobux")
 
 
-@dataclass(frozen=True, order=True)
+@functools.total_ordering
 class Bobux:
-    amount: int
-    spare_change: bool
+    """
+    An amount of bobux, which can include some spare change (half a
+    bobux).
+
+    Stored as a single integer number of half-bobux, the same way it is
+    stored in the database. Instances are immutable, and common small
+    values are shared rather than allocated each time.
+    """
+
+    __slots__ = ("halves",)
+
+    halves: int
 
     ZERO: ClassVar[Bobux]
 
+    def __new__(cls, amount: int, spare_change: bool = False) -> Bobux:
+        return cls.from_halves(amount * 2 + int(spare_change))
+
+    @classmethod
+    def from_halves(cls, halves: int) -> Bobux:
+        """
+        Create a bobux value from a number of half-bobux, as stored in the
+        database.
+
+        Parameters
+        ----------
+        halves: The number of half-bobux.
+
+        Returns
+        -------
+        The corresponding bobux value.
+        """
+
+        if _INTERNED_MIN <= halves <= _INTERNED_MAX:
+            return _interned[halves - _INTERNED_MIN]
+
+        result = object.__new__(cls)
+        object.__setattr__(result, "halves", halves)
+        return result
+
     @classmethod
-    def from_float(cls: Type[B], amount: float) -> B:
+    def from_float(cls, amount: float) -> Bobux:
         """
         Create a bobux value from a floating-point number.
 
@@ -37,26 +74,57 @@ class Bobux:
 
         return cls(int(amount), not amount.is_integer())
 
+    @property
+    def amount(self) -> int:
+        return self.halves >> 1
+
+    @property
+    def spare_change(self) -> bool:
+        return bool(self.halves & 1)
+
     def to_float(self) -> float:
-        return self.amount + (0.5 if self.spare_change else 0)
+        return self.halves / 2
+
+    def __setattr__(self, name: str, value: object):
+        raise AttributeError(f"cannot assign to field '{name}'")
+
+    def __delattr__(self, name: str):
+        raise AttributeError(f"cannot delete field '{name}'")
+
+    def __reduce__(self):
+        return (Bobux.from_halves, (self.halves,))
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, Bobux):
+            return self.halves == other.halves
+        return NotImplemented
+
+    def __lt__(self, other: Bobux) -> bool:
+        if isinstance(other, Bobux):
+            return self.halves < other.halves
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash(self.halves)
 
     def __add__(self, other: Bobux) -> Bobux:
-        amount = self.amount + other.amount
-        if self.spare_change and other.spare_change:
-            amount += 1
-        spare_change = self.spare_change ^ other.spare_change
-        return Bobux(amount, spare_change)
+        return Bobux.from_halves(self.halves + other.halves)
 
     def __sub__(self, other: Bobux) -> Bobux:
-        amount = self.amount - other.amount
-        if not self.spare_change and other.spare_change:
-            amount -= 1
-        spare_change = self.spare_change ^ other.spare_change
-        return Bobux(amount, spare_change)
+        return Bobux.from_halves(self.halves - other.halves)
+
+    def __mul__(self, other: int) -> Bobux:
+        if isinstance(other, int):
+            return Bobux.from_halves(self.halves * other)
+        return NotImplemented
+
+    __rmul__ = __mul__
 
     def __neg__(self) -> Bobux:
-        amount = -self.amount - int(self.spare_change)
-        return Bobux(amount, self.spare_change)
+        return Bobux.from_halves(-self.halves)
+
+    def __repr__(self) -> str:
+        return f"Bobux(amount={self.amount!r}, spare_change={self.spare_change!r})"
 
     def __str__(self) -> str:
         if self.spare_change:
@@ -65,6 +133,15 @@ class Bobux:
             return f"{self.amount} bobux"
 
 
+# Values in this range of half-bobux are created once and shared. This
+# covers every reward and most prices and balances.
+_INTERNED_MIN = -512
+_INTERNED_MAX = 1024
+_interned = [object.__new__(Bobux) for _ in range(_INTERNED_MIN, _INTERNED_MAX + 1)]
+for _halves, _bobux in zip(range(_INTERNED_MIN, _INTERNED_MAX + 1), _interned):
+    object.__setattr__(_bobux, "halves", _halves)
+del _halves, _bobux
+
 Bobux.ZERO = Bobux(0, False)
 
 
@@ -90,12 +167,22 @@ class Account:
         The current balance of this account.
         """
 
-        async with db_connection.cursor() as db_cursor:
+        key = (self.discord_user_id, self.discord_guild_id)
+
+        # Inside a transaction, the database may have changes that the
+        # cache won't see until they are committed.
+        use_cache = not utils.in_transaction(db_connection)
+        generation = balance_cache.balances.generation
+        if use_cache:
+            cached_halves = balance_cache.balances.get(key)
+            if cached_halves is not None:
+                return Bobux.from_halves(cached_halves)
+
+        async with database.read_cursor(db_connection) as db_cursor:
             await db_cursor.execute(
                 """
                 SELECT
-                    balance,
-                    spare_change
+                    balance
                 FROM
                     members
                 WHERE
@@ -105,8 +192,9 @@ class Account:
                 (self.discord_user_id, self.discord_guild_id),
             )
             row = await db_cursor.fetchone()
+            halves: int = row["balance"] if row is not None else 0
+
+        if use_cache:
+            balance_cache.balances.fill(key, halves, generation)
 
-            if row is not None:
-                return Bobux(row["balance"], row["spare_change"])
-            else:
-                return Bobux.ZERO
+        return Bobux.from_halves(halves)
@@ -5,12 +5,20 @@ from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import disnake
 from disnake.ext import commands
 
+from bobux_economy.checkpoints import VoteCheckpoints
 from bobux_economy.config.guild_config import GuildConfig
+from bobux_economy.group_commit import GroupCommit
+from bobux_economy.members import MemberResolver
+from bobux_economy.message_cache import MessageCache
 
 
 class BobuxEconomyBot(commands.InteractionBot):
     db_connection: aiosqlite.Connection
     scheduler: AsyncIOScheduler
+    group_commit: GroupCommit
+    message_cache: MessageCache
+    members: MemberResolver
+    vote_checkpoints: VoteCheckpoints
 
     def __init__(
         self,
@@ -35,6 +43,10 @@ class BobuxEconomyBot(commands.InteractionBot):
         )
         self.db_connection = db_connection
         self.scheduler = scheduler
+        self.group_commit = GroupCommit(db_connection)
+        self.message_cache = MessageCache()
+        self.members = MemberResolver()
+        self.vote_checkpoints = VoteCheckpoints(db_connection)
 
     def guild_config(self, guild: disnake.abc.Snowflake) -> GuildConfig:
         return GuildConfig(self.db_connection, guild)
@@ -0,0 +1,81 @@
+import logging
+from typing import Dict, Tuple
+
+import aiosqlite
+
+from bobux_economy import utils
+
+logger = logging.getLogger(__name__)
+
+# How often buffered checkpoints are written to the database, in seconds.
+FLUSH_INTERVAL = 5.0
+
+
+class VoteCheckpoints:
+    """
+    Buffers the last message seen in each vote channel and writes them to
+    the database in batches, instead of once per message.
+
+    Anything recorded since the last flush is lost if the process dies
+    without flushing, which only means a little more history is scanned
+    when votes are synchronized at startup.
+    """
+
+    db_connection: aiosqlite.Connection
+    _pending: Dict[int, Tuple[int, int]]
+
+    def __init__(self, db_connection: aiosqlite.Connection):
+        self.db_connection = db_connection
+        self._pending = {}
+
+    def record(self, guild_id: int, channel_id: int, message_id: int):
+        """
+        Record that a message has been seen in a vote channel.
+
+        Parameters
+        ----------
+        guild_id:   The guild the channel is in.
+        channel_id: The vote channel.
+        message_id: The message that was seen.
+        """
+
+        pending = self._pending.get(channel_id)
+        if pending is None or pending[1] < message_id:
+            self._pending[channel_id] = (guild_id, message_id)
+
+    async def flush(self):
+        """
+        Write every buffered checkpoint to the database in a single
+        transaction.
+        """
+
+        if len(self._pending) == 0:
+            return
+
+        pending, self._pending = self._pending, {}
+        try:
+            async with utils.db_transaction(self.db_connection) as db_cursor:
+                await db_cursor.executemany(
+                    """
+                    INSERT INTO
+                        vote_channel_checkpoints (channel_id, guild_id, last_message_id)
+                    VALUES
+                        (?, ?, ?)
+                    ON CONFLICT (channel_id) DO
+                    UPDATE
+                    SET
+                        last_message_id = MAX(last_message_id, excluded.last_message_id)
+                    """,
+                    [
+                        (channel_id, guild_id, message_id)
+                        for channel_id, (guild_id, message_id) in pending.items()
+                    ],
+                )
+        except:
+            # Keep the checkpoints for the next flush, unless they have
+            # been superseded in the meantime.
+            for channel_id, (guild_id, message_id) in pending.items():
+                self.record(guild_id, channel_id, message_id)
+            raise
+
+        logger.debug("Flushed %d vote channel checkpoints.", len(pending))
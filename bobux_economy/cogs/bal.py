@@ -1,12 +1,109 @@
-from typing import cast
+import time
+from typing import List, Optional, cast
 
+import aiosqlite
 import disnake
 from disnake.ext import commands
 
-from bobux_economy import balance, utils
+from bobux_economy import economy, leaderboard, utils
 from bobux_economy.bobux import Account, Bobux
 from bobux_economy.bot import BobuxEconomyBot
-from bobux_economy.transactions import create_transaction
+from bobux_economy.leaderboard import LeaderboardEntry
+from bobux_economy.transactions import (
+    NegativeAmount,
+    create_transaction,
+    create_transactions_bulk,
+)
+
+
+# How long leaderboard buttons keep working after the last click, in
+# seconds.
+LEADERBOARD_TIMEOUT = 300.0
+
+
+class LeaderboardView(disnake.ui.View):
+    """
+    Previous and next buttons for a leaderboard message. Each click loads
+    only the page being switched to.
+    """
+
+    db_connection: aiosqlite.Connection
+    guild_id: int
+    entries: List[LeaderboardEntry]
+    page_number: int
+    has_next_page: bool
+
+    def __init__(self, db_connection: aiosqlite.Connection, guild_id: int):
+        super().__init__(timeout=LEADERBOARD_TIMEOUT)
+        self.db_connection = db_connection
+        self.guild_id = guild_id
+        self.entries = []
+        self.page_number = 0
+        self.has_next_page = False
+
+    async def load_first_page(self):
+        await self._load_forwards(None)
+
+    def render(self) -> str:
+        first_position = self.page_number * leaderboard.PAGE_SIZE + 1
+        return "\n".join(
+            f"{position}. <@{entry.user_id}>: {entry.balance}"
+            for position, entry in enumerate(self.entries, first_position)
+        )
+
+    async def _load_forwards(self, after: Optional[LeaderboardEntry]):
+        # Ask for one extra entry to find out whether there is another
+        # page after this one.
+        entries = await leaderboard.get_page(
+            self.db_connection,
+            self.guild_id,
+            after=after,
+            limit=leaderboard.PAGE_SIZE + 1,
+        )
+        self.has_next_page = len(entries) > leaderboard.PAGE_SIZE
+        self.entries = entries[: leaderboard.PAGE_SIZE]
+        self._update_buttons()
+
+    def _update_buttons(self):
+        self.previous_page.disabled = self.page_number == 0
+        self.next_page.disabled = not self.has_next_page
+
+    @disnake.ui.button(label="Previous", style=disnake.ButtonStyle.gray)
+    async def previous_page(
+        self, _: disnake.ui.Button, inter: disnake.MessageInteraction
+    ):
+        entries = await leaderboard.get_page(
+            self.db_connection, self.guild_id, before=self.entries[0]
+        )
+        if len(entries) < leaderboard.PAGE_SIZE:
+            # Balances changed enough that this is now the first page.
+            await self.load_first_page()
+            self.page_number = 0
+        else:
+            self.entries = entries
+            self.page_number -= 1
+            self.has_next_page = True
+        self._update_buttons()
+
+        await inter.response.edit_message(
+            self.render(), allowed_mentions=disnake.AllowedMentions.none(), view=self
+        )
+
+    @disnake.ui.button(label="Next", style=disnake.ButtonStyle.gray)
+    async def next_page(self, _: disnake.ui.Button, inter: disnake.MessageInteraction):
+        previous_entries = self.entries
+        await self._load_forwards(self.entries[-1])
+        if len(self.entries) > 0:
+            self.page_number += 1
+        else:
+            # Everyone after this page has left the leaderboard since it
+            # was loaded.
+            self.entries = previous_entries
+        self._update_buttons()
+
+        await inter.response.edit_message(
+            self.render(), allowed_mentions=disnake.AllowedMentions.none(), view=self
+        )
 
 
 class Bal(commands.Cog):
@@ -15,6 +112,15 @@ class Bal(commands.Cog):
     def __init__(self, bot: BobuxEconomyBot):
         self.bot = bot
 
+        bot.scheduler.add_job(
+            economy.recompute,
+            "interval",
+            args=(bot.db_connection,),
+            seconds=economy.RECOMPUTE_INTERVAL,
+            id="recompute_balance_histograms",
+            replace_existing=True,
+        )
+
     @commands.slash_command(name="bal")
     async def slash_bal(self, _: disnake.GuildCommandInteraction):
         """Manage account balances"""
@@ -66,32 +172,67 @@ class Bal(commands.Cog):
     async def slash_bal_check_everyone(self, inter: disnake.GuildCommandInteraction):
         """Check the balance of everyone in this server"""
 
-        # TODO: Move this to a function in the new transactions API.
-        async with self.bot.db_connection.cursor() as db_cursor:
-            await db_cursor.execute(
-                """
-                    SELECT id, balance, spare_change FROM members WHERE guild_id = ?
-                        ORDER BY balance DESC, spare_change DESC
-                """,
-                (inter.guild.id,),
-            )
-            rows = await db_cursor.fetchall()
+        view = LeaderboardView(self.bot.db_connection, inter.guild.id)
+        await view.load_first_page()
 
-        message_parts = []
-        for member_id, amount, spare_change in rows:
-            message_parts.append(
-                f"<@{member_id}>: {balance.to_string(amount, spare_change)}"
-            )
-
-        if len(message_parts) > 0:
+        if len(view.entries) > 0:
             await inter.response.send_message(
-                "\n".join(message_parts),
+                view.render(),
                 allowed_mentions=disnake.AllowedMentions.none(),
+                view=view,
                 ephemeral=True,
             )
         else:
             await inter.response.send_message("No results", ephemeral=True)
 
+    @slash_bal.sub_command(name="rank")
+    async def slash_bal_rank(
+        self,
+        inter: disnake.GuildCommandInteraction,
+        user: Optional[disnake.Member] = None,
+    ):
+        """
+        Check where someone places on this server’s leaderboard
+
+        Parameters
+        ----------
+        user: The user to check the position of, or yourself if not given
+        """
+
+        member = user or inter.author
+        account = Account.from_member(member)
+        rank = await leaderboard.get_rank(self.bot.db_connection, account)
+
+        await inter.response.send_message(
+            f"{member.mention} is #{rank} in this server",
+            allowed_mentions=disnake.AllowedMentions.none(),
+            ephemeral=True,
+        )
+
+    @slash_bal.sub_command(name="stats")
+    async def slash_bal_stats(self, inter: disnake.GuildCommandInteraction):
+        """Show how wealth is distributed in this server"""
+
+        stats = await economy.get_stats(self.bot.db_connection, inter.guild.id)
+        if stats.accounts == 0:
+            await inter.response.send_message("No results", ephemeral=True)
+            return
+
+        await inter.response.send_message(
+            "\n".join(
+                [
+                    f"Economy of ‘{inter.guild.name}’:",
+                    f"Money supply: {stats.supply}",
+                    f"Accounts with a balance: {stats.accounts}",
+                    f"Median balance: about {stats.median}",
+                    f"Top 10% threshold: about {stats.top_decile_threshold}",
+                    f"Held by the top 10%: about {stats.top_decile_share:.0%}",
+                    f"Gini coefficient: about {stats.gini:.2f}",
+                ]
+            ),
+            ephemeral=True,
+        )
+
     @slash_bal.sub_command(name="set")
     @utils.has_admin_role()
     async def slash_bal_set(
@@ -193,6 +334,98 @@ class Bal(commands.Cog):
             ),
         )
 
+    async def _fetch_role_accounts(
+        self, guild: disnake.Guild, role: disnake.Role
+    ) -> List[Account]:
+        # The bot doesn't get members from the gateway, so the role's
+        # member list has to be fetched page by page.
+        try:
+            return [
+                Account.from_member(member)
+                async for member in guild.fetch_members(limit=None)
+                if role.is_default() or member.get_role(role.id) is not None
+            ]
+        except disnake.ClientException as ex:
+            raise utils.UserFacingError(
+                "Members can't be listed without the server members intent"
+            ) from ex
+
+    @slash_bal.sub_command(name="add_role")
+    @utils.has_admin_role()
+    async def slash_bal_add_role(
+        self,
+        inter: disnake.GuildCommandInteraction,
+        role: disnake.Role,
+        amount: float,
+    ):
+        """
+        Add bobux to the balance of everyone with a role
+
+        Parameters
+        ----------
+        role: The role whose members’ balances will be added to
+        amount: The amount to add to each member’s balance
+        """
+
+        transaction_amount = Bobux.from_float(amount)
+        # The sign is applied here, so a negative amount would reverse
+        # the direction of the change.
+        if transaction_amount < Bobux.ZERO:
+            raise NegativeAmount()
+
+        await inter.response.defer()
+        started_at = time.perf_counter()
+
+        accounts = await self._fetch_role_accounts(inter.guild, role)
+        count = await create_transactions_bulk(
+            self.bot.db_connection, accounts, transaction_amount
+        )
+
+        elapsed = time.perf_counter() - started_at
+        await inter.edit_original_response(
+            f"Added {transaction_amount} to the balances of {count} members "
+            f"with {role.mention} in {elapsed:.2f} s",
+            allowed_mentions=disnake.AllowedMentions.none(),
+        )
+
+    @slash_bal.sub_command(name="subtract_role")
+    @utils.has_admin_role()
+    async def slash_bal_subtract_role(
+        self,
+        inter: disnake.GuildCommandInteraction,
+        role: disnake.Role,
+        amount: float,
+    ):
+        """
+        Subtract bobux from the balance of everyone with a role
+
+        Parameters
+        ----------
+        role: The role whose members’ balances will be subtracted from
+        amount: The amount to subtract from each member’s balance
+        """
+
+        transaction_amount = Bobux.from_float(amount)
+        # The sign is applied here, so a negative amount would reverse
+        # the direction of the change.
+        if transaction_amount < Bobux.ZERO:
+            raise NegativeAmount()
+
+        await inter.response.defer()
+        started_at = time.perf_counter()
+
+        accounts = await self._fetch_role_accounts(inter.guild, role)
+        count = await create_transactions_bulk(
+            self.bot.db_connection, accounts, -transaction_amount
+        )
+
+        elapsed = time.perf_counter() - started_at
+        await inter.edit_original_response(
+            f"Subtracted {transaction_amount} from the balances of {count} members "
+            f"with {role.mention} in {elapsed:.2f} s",
+            allowed_mentions=disnake.AllowedMentions.none(),
+        )
+
     @commands.slash_command(name="pay")
     async def slash_pay(
         self,
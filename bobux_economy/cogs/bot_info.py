@@ -1,11 +1,12 @@
 """
-A cog that includes commands to check the current version of the bot and
-view the changelog for the bot.
+A cog that includes commands to check the current version of the bot,
+view the changelog for the bot, and view performance counters.
 """
 
 import disnake
 from disnake.ext import commands
 
+from bobux_economy import metrics
 from bobux_economy.bot import BobuxEconomyBot
 
 
@@ -43,6 +44,21 @@ class BotInfo(commands.Cog):
             ephemeral=True,
         )
 
+    @commands.slash_command(name="stats")
+    async def slash_stats(self, ctx: disnake.ApplicationCommandInteraction):
+        """Show the bot's performance counters"""
+
+        lines = [
+            f"`{c.name}`: {c.value} ({c.description})" for c in metrics.all_counters()
+        ]
+        lines.extend(
+            f"`{g.name}`: {g.value:g} ({g.description})" for g in metrics.all_gauges()
+        )
+        await ctx.send(
+            "\n".join(lines) if len(lines) > 0 else "No counters yet",
+            ephemeral=True,
+        )
+
 
 def setup(bot: BobuxEconomyBot):
     bot.add_cog(BotInfo(bot))
@@ -28,7 +28,8 @@ class ErrorHandling(commands.Cog):
 
     @classmethod
     async def send_error_feedback(cls, inter: disnake.Interaction, ex: Exception):
-        await inter.response.send_message(
+        # Works for deferred interactions too, by sending a followup.
+        await inter.send(
             cls.get_error_message(ex),
             allowed_mentions=disnake.AllowedMentions.none(),
             ephemeral=True,
@@ -2,9 +2,12 @@
 A cog containing commands to change the bot's configuration in a guild.
 """
 
+import calendar
+
 import disnake
 from disnake.ext import commands
 
+from bobux_economy import subscriptions
 from bobux_economy.bot import BobuxEconomyBot
 
 
@@ -74,6 +77,75 @@ class GuildConfig(commands.Cog):
             allowed_mentions=disnake.AllowedMentions.none(),
         )
 
+    @slash_config.sub_command_group(name="billing_time")
+    async def slash_config_billing_time(self, _: disnake.GuildCommandInteraction):
+        pass
+
+    @slash_config_billing_time.sub_command(name="get")
+    async def slash_config_billing_time_get(
+        self, inter: disnake.GuildCommandInteraction
+    ):
+        """
+        Show when subscriptions are charged each week
+        """
+
+        offset_minutes = await self.bot.guild_config(
+            inter.guild
+        ).billing_offset_minutes.get()
+        offset = subscriptions.billing_offset(inter.guild.id, offset_minutes)
+        billing_time = subscriptions.CYCLE_EPOCH + offset
+        billing_time_str = billing_time.strftime("%A at %H:%M")
+
+        if offset_minutes is None:
+            message = f"Subscriptions are charged every {billing_time_str} (chosen automatically)"
+        else:
+            message = f"Subscriptions are charged every {billing_time_str}"
+
+        await inter.response.send_message(message, ephemeral=True)
+
+    @slash_config_billing_time.sub_command(name="set")
+    @commands.has_guild_permissions(manage_guild=True)
+    async def slash_config_billing_time_set(
+        self,
+        inter: disnake.GuildCommandInteraction,
+        day: str = commands.Param(choices=list(calendar.day_name)),
+        hour: int = commands.Param(ge=0, le=23),
+    ):
+        """
+        Change when subscriptions are charged each week
+
+        Parameters
+        ----------
+        day: The day of the week to charge subscriptions on
+        hour: The hour of the day to charge subscriptions at, in the bot's time zone
+        """
+
+        offset_minutes = (list(calendar.day_name).index(day) * 24 + hour) * 60
+        await subscriptions.set_billing_offset(
+            self.bot.db_connection, inter.guild.id, offset_minutes
+        )
+
+        await inter.response.send_message(
+            f"Set billing time to {day} at {hour:02}:00"
+        )
+
+    @slash_config_billing_time.sub_command(name="unset")
+    @commands.has_guild_permissions(manage_guild=True)
+    async def slash_config_billing_time_unset(
+        self, inter: disnake.GuildCommandInteraction
+    ):
+        """
+        Unset the billing time, letting the bot choose one
+        """
+
+        await subscriptions.set_billing_offset(
+            self.bot.db_connection, inter.guild.id, None
+        )
+
+        await inter.response.send_message(
+            "Unset billing time; the bot will choose one automatically"
+        )
+
     @slash_config.sub_command_group(name="real_estate_category")
     async def slash_config_real_estate_category(
         self, _: disnake.GuildCommandInteraction
@@ -3,15 +3,11 @@ from typing import Union, cast
 import disnake
 from disnake.ext import commands
 
-from bobux_economy import balance, real_estate
+from bobux_economy import database, real_estate
 from bobux_economy.bot import BobuxEconomyBot
 
-TEXT_CHANNEL_PRICE_STR = balance.to_string(
-    *real_estate.CHANNEL_PRICES[disnake.ChannelType.text]
-)
-VOICE_CHANNEL_PRICE_STR = balance.to_string(
-    *real_estate.CHANNEL_PRICES[disnake.ChannelType.voice]
-)
+TEXT_CHANNEL_PRICE_STR = str(real_estate.CHANNEL_PRICES[disnake.ChannelType.text])
+VOICE_CHANNEL_PRICE_STR = str(real_estate.CHANNEL_PRICES[disnake.ChannelType.voice])
 
 
 class RealEstate(commands.Cog):
@@ -90,7 +86,7 @@ class RealEstate(commands.Cog):
 
         price = await real_estate.sell(self.bot.db_connection, channel, inter.author)
         await inter.response.send_message(
-            f"Sold ‘{channel.name}’ for {balance.to_string(*price)}",
+            f"Sold ‘{channel.name}’ for {price}",
             allowed_mentions=disnake.AllowedMentions.none(),
         )
 
@@ -130,7 +126,7 @@ class RealEstate(commands.Cog):
     async def _check_user_and_respond(
         self, inter: disnake.Interaction, user: disnake.Member
     ):
-        async with self.bot.db_connection.cursor() as db_cursor:
+        async with database.read_cursor(self.bot.db_connection) as db_cursor:
             await db_cursor.execute(
                 "SELECT id, purchase_time FROM purchased_channels WHERE owner_id = ?",
                 (user.id,),
@@ -156,7 +152,7 @@ class RealEstate(commands.Cog):
     ):
         """Check the real estate holdings of everyone in this server"""
 
-        async with self.bot.db_connection.cursor() as db_cursor:
+        async with database.read_cursor(self.bot.db_connection) as db_cursor:
             await db_cursor.execute(
                 """
                     SELECT id, owner_id, purchase_time FROM purchased_channels
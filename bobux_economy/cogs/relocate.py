@@ -3,6 +3,7 @@ from typing import Union
 import disnake
 from disnake.ext import commands
 
+from bobux_economy import webhooks
 from bobux_economy.bot import BobuxEconomyBot
 from bobux_economy.utils import UserFacingError
 
@@ -116,12 +117,7 @@ class Relocate(commands.Cog):
 
         # Permanently associate this webhook ID with the original
         # poster.
-        async with self.bot.db_connection.cursor() as db_cursor:
-            await db_cursor.execute(
-                "INSERT INTO webhooks VALUES(?, ?)",
-                (webhook.id, target_author.id),
-            )
-            await self.bot.db_connection.commit()
+        await webhooks.record(self.bot.db_connection, webhook.id, target_author.id)
 
         # Delete the webhook
         await webhook.delete(reason="Will no longer be used")
@@ -1,13 +1,10 @@
-import asyncio
 from datetime import datetime, timezone
-import logging
-from typing import Dict
 
 import disnake
 from disnake.ext import commands
 
-from bobux_economy import balance, subscriptions, transactions, utils
-from bobux_economy.bobux import Account, Bobux
+from bobux_economy import database, subscriptions, utils
+from bobux_economy.bobux import Bobux
 from bobux_economy.bot import BobuxEconomyBot
 from bobux_economy.cogs.error_handling import ErrorHandling
 
@@ -35,10 +32,7 @@ class Subscriptions(commands.Cog):
     def __init__(self, bot: BobuxEconomyBot):
         self.bot = bot
 
-    @commands.Cog.listener()
-    async def on_ready(self):
-        logging.info("Starting subscriptions background task...")
-        asyncio.create_task(subscriptions.run(self.bot))
+        subscriptions.schedule(bot)
 
     @commands.slash_command(name="subscriptions")
     async def slash_subscriptions(self, _: disnake.GuildCommandInteraction):
@@ -67,17 +61,13 @@ class Subscriptions(commands.Cog):
             await db_cursor.execute(
                 """
                 INSERT INTO
-                    available_subscriptions (role_id, guild_id, price, spare_change)
+                    available_subscriptions (role_id, guild_id, price)
                 VALUES
-                    (?, ?, ?, ?)
+                    (?, ?, ?)
                 """,
-                (
-                    role.id,
-                    inter.guild.id,
-                    price_per_week_bobux.amount,
-                    price_per_week_bobux.spare_change,
-                ),
+                (role.id, inter.guild.id, price_per_week_bobux.halves),
             )
+            await subscriptions.start_billing(db_cursor, [inter.guild.id])
 
         await inter.response.send_message(
             f"Created subscription for {role.mention} for {price_per_week_bobux} per week",
@@ -124,57 +114,60 @@ class Subscriptions(commands.Cog):
             allowed_mentions=disnake.AllowedMentions.none(),
         )
 
+    @slash_subscriptions.sub_command(name="next_charge")
+    async def slash_subscriptions_next_charge(
+        self, inter: disnake.GuildCommandInteraction
+    ):
+        """Show when subscriptions in this server will next be charged"""
+
+        next_charge = (
+            await subscriptions.next_charge(self.bot.db_connection, inter.guild.id)
+        ).astimezone()
+
+        if next_charge <= datetime.now().astimezone():
+            message = "Subscriptions in this server are due to be charged now."
+        else:
+            message = (
+                "Subscriptions in this server will next be charged "
+                f"{disnake.utils.format_dt(next_charge, 'F')} "
+                f"({disnake.utils.format_dt(next_charge, 'R')})."
+            )
+
+        await inter.response.send_message(message, ephemeral=True)
+
     @slash_subscriptions.sub_command(name="list")
     async def slash_subscriptions_list(self, inter: disnake.GuildCommandInteraction):
         """List available subscriptions"""
 
-        async with self.bot.db_connection.cursor() as db_cursor:
+        async with database.read_cursor(self.bot.db_connection) as db_cursor:
             await db_cursor.execute(
                 """
                 SELECT
-                    role_id,
+                    available_subscriptions.role_id,
                     price,
-                    spare_change
+                    subscribed_since
                 FROM
                     available_subscriptions
+                    LEFT JOIN member_subscriptions ON member_subscriptions.role_id = available_subscriptions.role_id
+                    AND member_id = ?
                 WHERE
                     guild_id = ?
                 """,
-                (inter.guild.id,),
+                (inter.author.id, inter.guild.id),
             )
-            available_subscriptions_rows = await db_cursor.fetchall()
-
-            await db_cursor.execute(
-                """
-                SELECT
-                    role_id,
-                    subscribed_since
-                FROM
-                    member_subscriptions
-                WHERE
-                    member_id = ?
-                """,
-                (inter.author.id,),
-            )
-            member_subscriptions_rows = await db_cursor.fetchall()
-            member_subscriptions_dict: Dict[int, datetime] = {
-                row["role_id"]: row["subscribed_since"]
-                for row in member_subscriptions_rows
-            }
+            rows = await db_cursor.fetchall()
 
         message_lines = [f"Available subscriptions in ‘{inter.guild.name}’:"]
-        for row in available_subscriptions_rows:
+        for row in rows:
             role_id: int = row["role_id"]
-            price_per_week = Bobux(int(row["price"]), bool(row["spare_change"]))
+            price_per_week = Bobux.from_halves(row["price"])
 
             line = f"<@&{role_id}>: {price_per_week} per week"
-            if role_id in member_subscriptions_dict:
-                # TODO: Use Discord's built-in support for displaying
-                #       timestamps.
-                subscribed_since = (
-                    member_subscriptions_dict[role_id]
-                    .replace(tzinfo=timezone.utc)
-                    .astimezone(None)
+            if row["subscribed_since"] is not None:
+                # Subscription times are stored in UTC without a time
+                # zone.
+                subscribed_since = disnake.utils.format_dt(
+                    row["subscribed_since"].replace(tzinfo=timezone.utc)
                 )
                 line += f" (subscribed since {subscribed_since})"
 
@@ -199,41 +192,32 @@ class Subscriptions(commands.Cog):
         role: The role of the subscription to subscribe to
         """
 
-        async with self.bot.db_connection.cursor() as db_cursor:
+        async with database.read_cursor(self.bot.db_connection) as db_cursor:
             await db_cursor.execute(
                 """
                 SELECT
                     price,
-                    spare_change
+                    EXISTS (
+                        SELECT
+                            1
+                        FROM
+                            member_subscriptions
+                        WHERE
+                            member_id = ?
+                            AND role_id = available_subscriptions.role_id
+                    ) AS already_subscribed
                 FROM
                     available_subscriptions
                 WHERE
                     role_id = ?
                 """,
-                (role.id,),
+                (inter.author.id, role.id),
             )
             row = await db_cursor.fetchone()
             if row is None:
                 raise SubscriptionNotFound(role)
-            price_per_week = Bobux(int(row["price"]), bool(row["spare_change"]))
-
-            await db_cursor.execute(
-                """
-                SELECT
-                    COUNT(*)
-                FROM
-                    member_subscriptions
-                WHERE
-                    member_id = ?
-                    AND role_id = ?
-                """,
-                (inter.author.id, role.id),
-            )
-            # Exactly one row will always be returned since we are using
-            # an aggregate function.
-            row = await db_cursor.fetchone()
-            assert row is not None
-            already_subscribed = bool(row[0])
+            price_per_week = Bobux.from_halves(row["price"])
+            already_subscribed = bool(row["already_subscribed"])
 
         if already_subscribed:
             raise AlreadySubscribed(role)
@@ -269,19 +253,12 @@ class Subscriptions(commands.Cog):
         # the global error handlers will not work. We have to handle the
         # error here.
         try:
-            async with utils.db_transaction(self.bot.db_connection) as db_cursor:
-                await transactions.create_transaction(
-                    self.bot.db_connection,
-                    source=Account.from_member(inter.author),
-                    destination=None,
-                    amount=price_per_week,
-                )
-                await subscriptions.subscribe(
-                    self.bot.db_connection, inter.author, role
-                )
-                await button_inter.response.edit_message(
-                    f"Subscribed to {role.mention}.", components=[]
-                )
+            await subscriptions.subscribe(
+                self.bot.db_connection, inter.author, role, price_per_week
+            )
+            await button_inter.response.edit_message(
+                f"Subscribed to {role.mention}.", components=[]
+            )
         except Exception as ex:
             if isinstance(ex, disnake.Forbidden):
                 # We know the bot has the Manage Roles permission
@@ -308,21 +285,24 @@ class Subscriptions(commands.Cog):
         role: The role of the subscription to unsubscribe from
         """
 
-        async with self.bot.db_connection.cursor() as db_cursor:
+        async with database.read_cursor(self.bot.db_connection) as db_cursor:
             await db_cursor.execute(
                 """
                 SELECT
-                    COUNT(*)
-                FROM
-                    member_subscriptions
-                WHERE
-                    member_id = ?
-                    AND role_id = ?
+                    EXISTS (
+                        SELECT
+                            1
+                        FROM
+                            member_subscriptions
+                        WHERE
+                            member_id = ?
+                            AND role_id = ?
+                    )
                 """,
                 (inter.author.id, role.id),
             )
-            # Exactly one row will always be returned since we are using
-            # an aggregate function.
+            # Exactly one row will always be returned since EXISTS is
+            # selected without a FROM clause.
             row = await db_cursor.fetchone()
             assert row is not None
             already_subscribed = bool(row[0])
@@ -1,45 +1,83 @@
+from datetime import datetime, timedelta, timezone
 import logging
+from typing import List, Optional, Tuple
 
 import disnake
 from disnake.ext import commands
 
-from bobux_economy import utils, upvotes
+from bobux_economy import checkpoints, upvotes, vote_sync
 from bobux_economy.bot import BobuxEconomyBot
+from bobux_economy.message_cache import MessageInfo
+from bobux_economy.vote_dispatcher import VoteDispatcher
 
 logger = logging.getLogger(__name__)
 
+# The number of messages shown by /top.
+TOP_MESSAGES_LIMIT = 10
+
 
 class Voting(commands.Cog):
     bot: BobuxEconomyBot
+    vote_dispatcher: VoteDispatcher[
+        Tuple[int, int], upvotes.VoteTarget, upvotes.ReactionEvent
+    ]
 
     def __init__(self, bot: BobuxEconomyBot):
         self.bot = bot
+        # Reaction events are applied one (message, member) pair at a
+        # time, so that concurrent events can't interleave their vote
+        # and reward updates.
+        self.vote_dispatcher = VoteDispatcher(self._apply_reaction_events)
+
+        bot.scheduler.add_job(
+            bot.vote_checkpoints.flush,
+            "interval",
+            seconds=checkpoints.FLUSH_INTERVAL,
+            id="flush_vote_checkpoints",
+            replace_existing=True,
+        )
+
+    async def _apply_reaction_events(
+        self, target: upvotes.VoteTarget, events: List[upvotes.ReactionEvent]
+    ):
+        await upvotes.apply_reaction_events(self.bot, target, events)
 
     @commands.Cog.listener()
     async def on_ready(self):
         logger.info("Synchronizing votes...")
-        await upvotes.sync_votes(self.bot)
+        await vote_sync.sync_votes(self.bot)
 
     @commands.Cog.listener()
     async def on_message(self, message: disnake.Message):
         if message.author == self.bot.user or message.guild is None:
             return
 
-        if await upvotes.message_eligible(self.bot.db_connection, message):
+        message_info = MessageInfo.from_message(message)
+        if await upvotes.message_eligible(self.bot.db_connection, message_info):
+            # Votes on this message can now be handled without fetching
+            # it again.
+            self.bot.message_cache.put(message_info)
+
             await upvotes.add_reactions(message)
-            async with utils.db_transaction(self.bot.db_connection) as db_cursor:
-                await db_cursor.execute(
-                    """
-                    INSERT INTO
-                        guilds (id, last_memes_message)
-                    VALUES
-                        (?, ?) ON CONFLICT (id) DO
-                    UPDATE
-                    SET
-                        last_memes_message = excluded.last_memes_message
-                    """,
-                    (message.guild.id, message.id),
-                )
+            self.bot.vote_checkpoints.record(
+                message.guild.id, message.channel.id, message.id
+            )
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload: disnake.RawMessageUpdateEvent):
+        # The content may have gained or lost a speech bubble.
+        self.bot.message_cache.evict(payload.message_id)
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: disnake.RawMessageDeleteEvent):
+        self.bot.message_cache.evict(payload.message_id)
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(
+        self, payload: disnake.RawBulkMessageDeleteEvent
+    ):
+        for message_id in payload.message_ids:
+            self.bot.message_cache.evict(message_id)
 
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload: disnake.RawReactionActionEvent):
@@ -49,12 +87,19 @@ class Voting(commands.Cog):
         if payload.guild_id is None:
             return
 
+        if not await upvotes.channel_eligible(
+            self.bot.db_connection, payload.guild_id, payload.channel_id
+        ):
+            return
+
         channel = self.bot.get_channel(payload.channel_id)
         if not isinstance(channel, disnake.abc.Messageable):
             logger.error("Reaction added in non-messageable channel (how?)")
             return
 
-        message = await channel.fetch_message(payload.message_id)
+        message = await self.bot.message_cache.get_or_fetch(
+            channel, payload.message_id
+        )
         if not await upvotes.message_eligible(self.bot.db_connection, message):
             return
 
@@ -68,33 +113,19 @@ class Voting(commands.Cog):
         else:
             return
 
-        guild = self.bot.get_guild(payload.guild_id) or message.guild
+        guild = self.bot.get_guild(payload.guild_id)
         if guild is None:
             return
 
-        original_author = await upvotes.get_original_author(
-            self.bot.db_connection, message, guild
+        target = upvotes.VoteTarget(
+            message,
+            channel.get_partial_message(payload.message_id),
+            guild,
+            payload.member,
         )
-        if original_author is None:
-            return
-
-        if payload.user_id == original_author.id:
-            # The poster voted on their own message.
-            await upvotes.remove_extra_reactions(message, payload.member, None)
-            return
-
-        previous_vote = await upvotes.record_vote(
-            self.bot, payload.message_id, payload.channel_id, payload.member.id, vote
+        self.vote_dispatcher.submit(
+            target.key, target, upvotes.ReactionEvent(vote, added=True)
         )
-        await upvotes.give_vote_rewards_raw(
-            self.bot,
-            payload.message_id,
-            payload.channel_id,
-            payload.member.id,
-            previous_vote,
-            vote,
-        )
-        await upvotes.remove_extra_reactions(message, payload.member, vote)
 
     @commands.Cog.listener()
     async def on_raw_reaction_remove(self, payload: disnake.RawReactionActionEvent):
@@ -102,12 +133,19 @@ class Voting(commands.Cog):
             # The removed reaction was from the bot.
             return
 
+        if not await upvotes.channel_eligible(
+            self.bot.db_connection, payload.guild_id, payload.channel_id
+        ):
+            return
+
         channel = self.bot.get_channel(payload.channel_id)
         if not isinstance(channel, disnake.abc.Messageable):
             logging.error("Reaction removed in non-messageable channel (how?)")
             return
 
-        message = await channel.fetch_message(payload.message_id)
+        message = await self.bot.message_cache.get_or_fetch(
+            channel, payload.message_id
+        )
         if not await upvotes.message_eligible(self.bot.db_connection, message):
             return
 
@@ -118,34 +156,65 @@ class Voting(commands.Cog):
         else:
             return
 
-        if (
-            payload.message_id,
-            vote,
-            payload.user_id,
-        ) in upvotes.recently_removed_reactions:
-            upvotes.recently_removed_reactions.remove(
-                (payload.message_id, vote, payload.user_id)
-            )
+        if upvotes.recently_removed_reactions.consume(
+            (payload.message_id, vote, payload.user_id)
+        ):
             return
 
-        previous_vote = await upvotes.delete_vote(
-            self.bot,
-            payload.message_id,
-            payload.user_id,
-            check_equal_to=vote,
+        guild = self.bot.get_guild(payload.guild_id)
+        if guild is None:
+            return
+
+        target = upvotes.VoteTarget(
+            message,
+            channel.get_partial_message(payload.message_id),
+            guild,
+            disnake.Object(payload.user_id),
         )
-        await upvotes.give_vote_rewards_raw(
-            self.bot,
-            payload.message_id,
-            payload.channel_id,
-            payload.user_id,
-            previous_vote,
-            None,
+        self.vote_dispatcher.submit(
+            target.key, target, upvotes.ReactionEvent(vote, added=False)
+        )
+
+    @commands.slash_command(name="top")
+    async def slash_top(
+        self,
+        inter: disnake.GuildCommandInteraction,
+        channel: Optional[disnake.TextChannel] = None,
+        days: int = commands.Param(default=7, ge=1, le=365),
+    ):
+        """
+        Show the highest scoring posts in this server
+
+        Parameters
+        ----------
+        channel: Only show posts from this channel
+        days: How many days back to look
+        """
+
+        since = datetime.now(timezone.utc) - timedelta(days=days)
+        rows = await upvotes.top_messages(
+            self.bot.db_connection,
+            inter.guild.id,
+            disnake.utils.time_snowflake(since),
+            channel_id=channel.id if channel is not None else None,
+            limit=TOP_MESSAGES_LIMIT,
         )
-        user = self.bot.get_user(payload.user_id) or await self.bot.fetch_user(
-            payload.user_id
+
+        where = channel.mention if channel is not None else f"**{inter.guild.name}**"
+        message_lines = [f"Top posts in {where} from the last {days} days:"]
+        for rank, row in enumerate(rows, start=1):
+            jump_url = f"https://discord.com/channels/{row['guild_id']}/{row['channel_id']}/{row['message_id']}"
+            author = f"<@{row['author_id']}>" if row["author_id"] is not None else "unknown"
+            message_lines.append(
+                f"{rank}. {jump_url} by {author}: {row['score']:+d} "
+                f"({upvotes.UPVOTE_EMOJI} {row['upvotes']} / {upvotes.DOWNVOTE_EMOJI} {row['downvotes']})"
+            )
+
+        await inter.response.send_message(
+            "\n".join(message_lines) if len(rows) > 0 else "No results",
+            allowed_mentions=disnake.AllowedMentions.none(),
+            ephemeral=True,
         )
-        await upvotes.remove_extra_reactions(message, user, None)
 
 
 def setup(bot: BobuxEconomyBot):
@@ -4,11 +4,32 @@ import aiosqlite
 import disnake
 from typing_extensions import LiteralString
 
-from bobux_economy.config.option import BasicOption, SetOption
+from bobux_economy.config.option import BasicOption, SetOption, SetOptionCache
+
+
+# Vote channels are checked on every message and reaction the bot sees,
+# so they are kept in memory for the lifetime of the process.
+vote_channel_ids_cache: SetOptionCache[int] = SetOptionCache(
+    "guild_config_vote_channel_ids"
+)
+
+
+async def load_caches(db_connection: aiosqlite.Connection):
+    """
+    Load the in-memory caches used by `GuildConfig`. Should be called
+    once at startup, before any events are handled.
+
+    Parameters
+    ----------
+    db_connection: A connection to the SQLite database in use.
+    """
+
+    await vote_channel_ids_cache.load(db_connection)
 
 
 class GuildConfig:
     admin_role_id: BasicOption[int]
+    billing_offset_minutes: BasicOption[int]
     real_estate_category_id: BasicOption[int]
     vote_channel_ids: SetOption[int]
 
@@ -19,7 +40,11 @@ class GuildConfig:
             return BasicOption(db_connection, "guild_config", guild, name)
 
         self.admin_role_id = make_option("admin_role_id")
+        self.billing_offset_minutes = make_option("billing_offset_minutes")
         self.real_estate_category_id = make_option("real_estate_category_id")
         self.vote_channel_ids = SetOption(
-            db_connection, "guild_config_vote_channel_ids", guild
+            db_connection,
+            "guild_config_vote_channel_ids",
+            guild,
+            cache=vote_channel_ids_cache,
         )
@@ -1,10 +1,11 @@
-from typing import Generic, Optional, TypeVar
+import functools
+from typing import Dict, Generic, Optional, Set, TypeVar
 from typing_extensions import LiteralString
 
 import aiosqlite
 import disnake
 
-from bobux_economy import utils
+from bobux_economy import database, utils
 
 
 # Any type that is compatible with SQLite
@@ -34,7 +35,7 @@ class BasicOption(Generic[TSqlite]):
         self.name = name
 
     async def get(self) -> Optional[TSqlite]:
-        async with self.db_connection.cursor() as db_cursor:
+        async with database.read_cursor(self.db_connection) as db_cursor:
             await db_cursor.execute(
                 f"SELECT {self.name} FROM {self.table_name} WHERE snowflake = ?",
                 (self.snowflake.id,),
@@ -67,28 +68,107 @@ class BasicOption(Generic[TSqlite]):
             )
 
 
+class SetOptionCache(Generic[TSqlite]):
+    """
+    An in-memory copy of every set stored in a `SetOption` table, keyed
+    by snowflake.
+
+    The cache is empty until `load` is called, and `SetOption` will keep
+    reading from the database until then. Once loaded, `SetOption` keeps
+    the cache up to date whenever it modifies the table.
+    """
+
+    table_name: LiteralString
+    loaded: bool
+    _sets: Dict[int, Set[TSqlite]]
+
+    def __init__(self, table_name: LiteralString):
+        self.table_name = table_name
+        self.loaded = False
+        self._sets = {}
+
+    async def load(self, db_connection: aiosqlite.Connection):
+        """
+        Load every set in the table with a single query, replacing the
+        current contents of the cache.
+
+        Parameters
+        ----------
+        db_connection: A connection to the SQLite database in use.
+        """
+
+        sets: Dict[int, Set[TSqlite]] = {}
+        async with db_connection.cursor() as db_cursor:
+            await db_cursor.execute(f"SELECT snowflake, value FROM {self.table_name}")
+            for row in await db_cursor.fetchall():
+                sets.setdefault(row["snowflake"], set()).add(row["value"])
+
+        self._sets = sets
+        self.loaded = True
+
+    def get(self, snowflake_id: int) -> Set[TSqlite]:
+        return set(self._sets.get(snowflake_id, ()))
+
+    def contains(self, snowflake_id: int, value: TSqlite) -> bool:
+        values = self._sets.get(snowflake_id)
+        return values is not None and value in values
+
+    def add(self, snowflake_id: int, value: TSqlite):
+        self._sets.setdefault(snowflake_id, set()).add(value)
+
+    def discard(self, snowflake_id: int, value: TSqlite):
+        values = self._sets.get(snowflake_id)
+        if values is not None:
+            values.discard(value)
+            if not values:
+                del self._sets[snowflake_id]
+
+    def clear(self, snowflake_id: int):
+        self._sets.pop(snowflake_id, None)
+
+
 class SetOption(Generic[TSqlite]):
     """
     An option of a set of an SQLite-compatible type represented as an
     SQL table.
+
+    If a loaded `SetOptionCache` for the same table is provided, reads
+    are served from memory instead of the database.
     """
 
     db_connection: aiosqlite.Connection
     table_name: LiteralString
     snowflake: disnake.abc.Snowflake
+    cache: Optional[SetOptionCache[TSqlite]]
 
     def __init__(
         self,
         db_connection: aiosqlite.Connection,
         table_name: LiteralString,
         snowflake: disnake.abc.Snowflake,
+        cache: Optional[SetOptionCache[TSqlite]] = None,
     ):
+        if cache is not None and cache.table_name != table_name:
+            raise ValueError(
+                f"Cache for table '{cache.table_name}' cannot be used for table '{table_name}'"
+            )
+
         self.db_connection = db_connection
         self.table_name = table_name
         self.snowflake = snowflake
+        self.cache = cache
+
+    def _loaded_cache(self) -> Optional[SetOptionCache[TSqlite]]:
+        if self.cache is not None and self.cache.loaded:
+            return self.cache
+        return None
 
     async def get(self) -> set[TSqlite]:
-        async with self.db_connection.cursor() as db_cursor:
+        cache = self._loaded_cache()
+        if cache is not None:
+            return cache.get(self.snowflake.id)
+
+        async with database.read_cursor(self.db_connection) as db_cursor:
             await db_cursor.execute(
                 f"SELECT value FROM {self.table_name} WHERE snowflake = ?",
                 (self.snowflake.id,),
@@ -96,7 +176,11 @@ class SetOption(Generic[TSqlite]):
             return {row["value"] for row in await db_cursor.fetchall()}
 
     async def contains(self, value: TSqlite) -> bool:
-        async with self.db_connection.cursor() as db_cursor:
+        cache = self._loaded_cache()
+        if cache is not None:
+            return cache.contains(self.snowflake.id, value)
+
+        async with database.read_cursor(self.db_connection) as db_cursor:
             # This SQL formatting is questionable...
             await db_cursor.execute(
                 f"""
@@ -115,7 +199,7 @@ class SetOption(Generic[TSqlite]):
             )
             row = await db_cursor.fetchone()
             assert row is not None
-            
+
             return bool(row[0])
 
     async def add(self, value: TSqlite):
@@ -130,6 +214,13 @@ class SetOption(Generic[TSqlite]):
                 (self.snowflake.id, value),
             )
 
+            cache = self._loaded_cache()
+            if cache is not None:
+                utils.after_commit(
+                    self.db_connection,
+                    functools.partial(cache.add, self.snowflake.id, value),
+                )
+
     async def remove(self, value: TSqlite) -> bool:
         async with utils.db_transaction(self.db_connection) as db_cursor:
             await db_cursor.execute(
@@ -141,7 +232,16 @@ class SetOption(Generic[TSqlite]):
                 """,
                 (self.snowflake.id, value),
             )
-            return bool(db_cursor.rowcount)
+            removed = bool(db_cursor.rowcount)
+
+            cache = self._loaded_cache()
+            if cache is not None:
+                utils.after_commit(
+                    self.db_connection,
+                    functools.partial(cache.discard, self.snowflake.id, value),
+                )
+
+        return removed
 
     async def clear(self) -> int:
         async with utils.db_transaction(self.db_connection) as db_cursor:
@@ -153,4 +253,13 @@ class SetOption(Generic[TSqlite]):
                 """,
                 (self.snowflake.id,),
             )
-            return db_cursor.rowcount
+            rows_deleted = db_cursor.rowcount
+
+            cache = self._loaded_cache()
+            if cache is not None:
+                utils.after_commit(
+                    self.db_connection,
+                    functools.partial(cache.clear, self.snowflake.id),
+                )
+
+        return rows_deleted
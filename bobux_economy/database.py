@@ -0,0 +1,243 @@
+"""
+Connections to the SQLite database.
+
+The database runs in WAL mode, so one writer connection and any number of
+read-only connections can be used at the same time without blocking each
+other. Reads that don't need to see uncommitted writes go through
+`read_cursor`, which uses a reader connection when one is available.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+import json
+import sqlite3
+from typing import AsyncIterator, List, Optional
+from weakref import WeakKeyDictionary
+
+import aiosqlite
+
+from bobux_economy import utils
+
+# The defaults for the pragmas applied to every connection. The cache
+# size is in KiB when negative, and the mmap size is in bytes.
+SYNCHRONOUS = "NORMAL"
+CACHE_SIZE = -16384
+MMAP_SIZE = 64 * 1024 * 1024
+
+# The default number of read-only connections kept open. With none, all
+# reads go through the writer connection.
+READER_POOL_SIZE = 4
+
+_SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
+
+@dataclass(frozen=True)
+class DatabaseSettings:
+    synchronous: str = SYNCHRONOUS
+    cache_size: int = CACHE_SIZE
+    mmap_size: int = MMAP_SIZE
+    reader_pool_size: int = READER_POOL_SIZE
+
+
+def load_settings(path: str) -> DatabaseSettings:
+    """
+    Read database settings from a JSON object with any of the fields of
+    `DatabaseSettings`. Missing fields, or a missing file, use the
+    defaults.
+
+    Parameters
+    ----------
+    path: The path to the settings file.
+
+    Returns
+    -------
+    The settings to connect with.
+    """
+
+    try:
+        with open(path, "r") as settings_file:
+            fields = json.load(settings_file)
+    except FileNotFoundError:
+        return DatabaseSettings()
+
+    settings = DatabaseSettings(**fields)
+    # The mode is interpolated into a pragma, so it must be one that
+    # SQLite knows.
+    if settings.synchronous.upper() not in _SYNCHRONOUS_MODES:
+        raise ValueError(f"Invalid synchronous mode {settings.synchronous!r}")
+    if settings.reader_pool_size < 0:
+        raise ValueError("The reader pool size can't be negative")
+    return settings
+
+
+async def _configure(db_connection: aiosqlite.Connection, settings: DatabaseSettings):
+    # This will not affect existing code since sqlite3.Row objects
+    # support the same operations as tuples.
+    db_connection.row_factory = sqlite3.Row
+
+    await db_connection.execute(f"PRAGMA synchronous = {settings.synchronous.upper()}")
+    await db_connection.execute(f"PRAGMA cache_size = {int(settings.cache_size)}")
+    await db_connection.execute(f"PRAGMA mmap_size = {int(settings.mmap_size)}")
+
+
+async def connect_writer(
+    path: str, settings: DatabaseSettings = DatabaseSettings()
+) -> aiosqlite.Connection:
+    """
+    Open the connection that all writes go through, switching the
+    database to WAL mode if it isn't already.
+
+    Parameters
+    ----------
+    path:     The path to the database file.
+    settings: The pragmas to apply.
+
+    Returns
+    -------
+    The writer connection.
+    """
+
+    db_connection = await aiosqlite.connect(
+        path, detect_types=sqlite3.PARSE_DECLTYPES
+    )
+    await db_connection.execute("PRAGMA journal_mode = WAL")
+    await _configure(db_connection, settings)
+    return db_connection
+
+
+class ReaderPool:
+    """
+    A fixed number of read-only connections to the database, handed out
+    one cursor at a time.
+    """
+
+    path: str
+    settings: DatabaseSettings
+    _connections: List[aiosqlite.Connection]
+    _idle: "asyncio.Queue[aiosqlite.Connection]"
+
+    def __init__(self, path: str, settings: DatabaseSettings = DatabaseSettings()):
+        """
+        Parameters
+        ----------
+        path:     The path to the database file.
+        settings: The pragmas to apply and the number of connections to
+                  open.
+        """
+
+        self.path = path
+        self.settings = settings
+        self._connections = []
+        self._idle = asyncio.Queue()
+
+    async def open(self):
+        for _ in range(self.settings.reader_pool_size):
+            db_connection = await aiosqlite.connect(
+                f"file:{self.path}?mode=ro",
+                uri=True,
+                detect_types=sqlite3.PARSE_DECLTYPES,
+            )
+            await _configure(db_connection, self.settings)
+            self._connections.append(db_connection)
+            self._idle.put_nowait(db_connection)
+
+    async def close(self):
+        for db_connection in self._connections:
+            await db_connection.close()
+        self._connections.clear()
+
+    @asynccontextmanager
+    async def cursor(self) -> AsyncIterator[aiosqlite.Cursor]:
+        """
+        Borrow a reader connection for as long as the returned cursor is
+        in use. Waits for one to become idle if they are all busy.
+        """
+
+        db_connection = await self._idle.get()
+        try:
+            async with db_connection.cursor() as db_cursor:
+                yield db_cursor
+        finally:
+            self._idle.put_nowait(db_connection)
+
+
+_reader_pools: "WeakKeyDictionary[aiosqlite.Connection, ReaderPool]" = (
+    WeakKeyDictionary()
+)
+
+
+def attach_readers(db_connection: aiosqlite.Connection, readers: ReaderPool):
+    """
+    Send reads made through `read_cursor` for a writer connection to a
+    pool of reader connections instead.
+
+    Parameters
+    ----------
+    db_connection: The writer connection.
+    readers:       The pool of reader connections to the same database.
+    """
+
+    _reader_pools[db_connection] = readers
+
+
+@asynccontextmanager
+async def read_cursor(
+    db_connection: aiosqlite.Connection,
+) -> AsyncIterator[aiosqlite.Cursor]:
+    """
+    Get a cursor for read-only queries.
+
+    Inside a transaction on the given connection, the cursor belongs to
+    that connection so that the transaction's own writes are visible.
+    Otherwise, a reader connection is used if any are attached.
+
+    Parameters
+    ----------
+    db_connection: The writer connection.
+    """
+
+    readers: Optional[ReaderPool] = None
+    if not utils.in_transaction(db_connection):
+        readers = _reader_pools.get(db_connection)
+
+    if readers is not None:
+        async with readers.cursor() as db_cursor:
+            yield db_cursor
+    else:
+        async with db_connection.cursor() as db_cursor:
+            yield db_cursor
+
+
+@asynccontextmanager
+async def read_snapshot(
+    db_connection: aiosqlite.Connection,
+) -> AsyncIterator[aiosqlite.Cursor]:
+    """
+    Get a cursor whose queries all see the same committed state of the
+    database, for reads that span several queries.
+
+    When reader connections are attached, the snapshot is a read
+    transaction on one of them, and writes go on while it is open.
+    Otherwise, it is a transaction on the writer connection, which holds
+    off other writes until it ends.
+
+    Parameters
+    ----------
+    db_connection: The writer connection.
+    """
+
+    readers: Optional[ReaderPool] = None
+    if not utils.in_transaction(db_connection):
+        readers = _reader_pools.get(db_connection)
+
+    if readers is not None:
+        async with readers.cursor() as db_cursor:
+            await db_cursor.execute("BEGIN")
+            try:
+                yield db_cursor
+            finally:
+                await db_cursor.execute("ROLLBACK")
+    else:
+        async with utils.db_transaction(db_connection) as db_cursor:
+            yield db_cursor
@@ -0,0 +1,320 @@
+"""
+Per-guild statistics about the distribution of wealth.
+
+Every balance change made through `transactions` also updates a histogram
+of balances in the same database transaction. Accounts are grouped into
+buckets by the bit length of their balance in half-bobux, with the sign
+of the balance, so that statistics can be read from a few dozen rows
+instead of a scan of every account.
+
+Accounts with a balance of zero are treated the same as accounts that
+have never been used, and are not counted.
+"""
+
+from dataclasses import dataclass
+import logging
+import time
+from typing import Dict, List, Tuple
+
+import aiosqlite
+
+from bobux_economy import database, metrics, utils
+from bobux_economy.bobux import Bobux
+
+logger = logging.getLogger(__name__)
+
+# How often the histograms are checked against the balances they
+# summarize, in seconds.
+RECOMPUTE_INTERVAL = 6 * 60 * 60
+
+# The number of balances read at a time while recomputing.
+RECOMPUTE_FETCH_SIZE = 1000
+
+drift_repairs = metrics.counter(
+    "economy.drift_repairs",
+    "Guild histograms that had drifted from the balances and were repaired.",
+)
+
+
+def bucket(halves: int) -> int:
+    """
+    Get the histogram bucket of a balance. Buckets are ordered the same
+    way as the balances in them.
+
+    Parameters
+    ----------
+    halves: A balance in half-bobux.
+
+    Returns
+    -------
+    The bit length of the balance, negated for negative balances.
+    """
+
+    if halves < 0:
+        return -(-halves).bit_length()
+    return halves.bit_length()
+
+
+def _bucket_bounds(b: int) -> Tuple[int, int]:
+    if b < 0:
+        return -((1 << -b) - 1), -(1 << (-b - 1))
+    if b == 0:
+        return 0, 0
+    return 1 << (b - 1), (1 << b) - 1
+
+
+# Changes to the histogram, keyed by guild ID and bucket, as a change in
+# the number of accounts and a change in the total balance.
+HistogramDelta = Dict[Tuple[int, int], Tuple[int, int]]
+
+
+def add_balance_change(
+    delta: HistogramDelta, guild_id: int, old_halves: int, new_halves: int
+):
+    """
+    Add the effect of one account's balance changing to a set of
+    histogram changes.
+
+    Parameters
+    ----------
+    delta:      The changes to add to.
+    guild_id:   The guild the account is in.
+    old_halves: The balance before the change, in half-bobux.
+    new_halves: The balance after the change, in half-bobux.
+    """
+
+    for halves, sign in ((old_halves, -1), (new_halves, 1)):
+        if halves == 0:
+            continue
+        key = (guild_id, bucket(halves))
+        count, total = delta.get(key, (0, 0))
+        delta[key] = (count + sign, total + sign * halves)
+
+
+async def apply_delta(db_cursor: aiosqlite.Cursor, delta: HistogramDelta):
+    """
+    Write a set of histogram changes. Must be called in the same
+    transaction as the balance changes it reflects.
+
+    Parameters
+    ----------
+    db_cursor: A cursor inside the transaction.
+    delta:     The changes to write.
+    """
+
+    rows = [
+        (guild_id, b, count, total)
+        for (guild_id, b), (count, total) in delta.items()
+        if count != 0 or total != 0
+    ]
+    if len(rows) == 0:
+        return
+
+    await db_cursor.executemany(
+        """
+        INSERT INTO
+            balance_histogram (guild_id, bucket, count, total)
+        VALUES
+            (?, ?, ?, ?)
+        ON CONFLICT (guild_id, bucket) DO
+        UPDATE
+        SET
+            count = count + excluded.count,
+            total = total + excluded.total
+        """,
+        rows,
+    )
+
+
+@dataclass(frozen=True)
+class EconomyStats:
+    """
+    Statistics about the balances in a guild. Everything other than the
+    supply and the number of accounts is estimated from the histogram.
+    """
+
+    supply: Bobux
+    accounts: int
+    median: Bobux
+    top_decile_threshold: Bobux
+    top_decile_share: float
+    gini: float
+
+
+def _quantile(buckets: List[Tuple[int, int, int]], accounts: int, q: float) -> int:
+    # Interpolate linearly between the bounds of the bucket that the
+    # requested rank falls in.
+    rank = q * (accounts - 1)
+    seen = 0
+    for b, count, _ in buckets:
+        if count <= 0:
+            continue
+        if rank < seen + count:
+            low, high = _bucket_bounds(b)
+            # A fractional rank in the last slot of a bucket would
+            # otherwise land past its upper bound.
+            fraction = min(max((rank - seen + 0.5) / count, 0.0), 1.0)
+            return round(low + fraction * (high - low))
+        seen += count
+    return 0
+
+
+def _top_share(buckets: List[Tuple[int, int, int]], accounts: int) -> float:
+    # Shares are of the positive balances only, since debts would make
+    # the total meaningless as a denominator.
+    wealth = sum(total for b, count, total in buckets if b > 0 and count > 0)
+    if wealth <= 0:
+        return 0.0
+
+    # Take whole buckets from the top, then the average balance of the
+    # last bucket for the accounts still needed.
+    remaining = accounts * 0.1
+    top_total = 0.0
+    for _, count, total in reversed(buckets):
+        if remaining <= 0:
+            break
+        if count <= 0:
+            continue
+        taken = min(count, remaining)
+        top_total += total * taken / count
+        remaining -= taken
+    return top_total / wealth
+
+
+def _gini(buckets: List[Tuple[int, int, int]]) -> float:
+    # The grouped-data formula, treating every account in a bucket as
+    # having the bucket's average balance. Debts are left out, since the
+    # coefficient is only meaningful for non-negative values.
+    positive = [(count, total) for b, count, total in buckets if b > 0 and count > 0]
+    accounts = sum(count for count, _ in positive)
+    wealth = sum(total for _, total in positive)
+    if accounts == 0 or wealth <= 0:
+        return 0.0
+
+    area = 0.0
+    cumulative_share = 0.0
+    for count, total in positive:
+        previous_share = cumulative_share
+        cumulative_share += total / wealth
+        area += (count / accounts) * (previous_share + cumulative_share)
+    return 1.0 - area
+
+
+async def get_stats(db_connection: aiosqlite.Connection, guild_id: int) -> EconomyStats:
+    """
+    Get statistics about the balances in a guild, reading only its
+    histogram.
+
+    Parameters
+    ----------
+    db_connection: A connection to the SQLite database in use.
+    guild_id:      The guild to get statistics for.
+
+    Returns
+    -------
+    The statistics for the guild.
+    """
+
+    async with database.read_cursor(db_connection) as db_cursor:
+        await db_cursor.execute(
+            """
+            SELECT
+                bucket,
+                count,
+                total
+            FROM
+                balance_histogram
+            WHERE
+                guild_id = ?
+            ORDER BY
+                bucket
+            """,
+            (guild_id,),
+        )
+        buckets = [
+            (row["bucket"], row["count"], row["total"])
+            for row in await db_cursor.fetchall()
+        ]
+
+    accounts = sum(count for _, count, _ in buckets)
+    supply = sum(total for _, _, total in buckets)
+
+    return EconomyStats(
+        supply=Bobux.from_halves(supply),
+        accounts=accounts,
+        median=Bobux.from_halves(_quantile(buckets, accounts, 0.5)),
+        top_decile_threshold=Bobux.from_halves(_quantile(buckets, accounts, 0.9)),
+        top_decile_share=_top_share(buckets, accounts),
+        gini=_gini(buckets),
+    )
+
+
+async def recompute(db_connection: aiosqlite.Connection) -> int:
+    """
+    Rebuild the histograms from the balances, and repair the stored
+    histogram of every guild that has drifted from them.
+
+    The balances and the stored histograms are read from one snapshot,
+    so the scan doesn't hold off writes when reader connections are
+    attached. Every write keeps the two in step, so the drift found in
+    the snapshot is still the drift afterwards, and it is repaired by
+    writing the difference.
+
+    Parameters
+    ----------
+    db_connection: A connection to the SQLite database in use.
+
+    Returns
+    -------
+    The number of guilds whose histograms were repaired.
+    """
+
+    started_at = time.monotonic()
+
+    async with database.read_snapshot(db_connection) as db_cursor:
+        expected: HistogramDelta = {}
+        await db_cursor.execute("SELECT guild_id, balance FROM members WHERE balance != 0")
+        while True:
+            rows = await db_cursor.fetchmany(RECOMPUTE_FETCH_SIZE)
+            if len(rows) == 0:
+                break
+            for row in rows:
+                add_balance_change(expected, row["guild_id"], 0, row["balance"])
+
+        await db_cursor.execute(
+            "SELECT guild_id, bucket, count, total FROM balance_histogram"
+        )
+        stored: HistogramDelta = {
+            (row["guild_id"], row["bucket"]): (row["count"], row["total"])
+            for row in await db_cursor.fetchall()
+        }
+
+    drift: HistogramDelta = {}
+    for key in expected.keys() | stored.keys():
+        expected_count, expected_total = expected.get(key, (0, 0))
+        stored_count, stored_total = stored.get(key, (0, 0))
+        if (expected_count, expected_total) != (stored_count, stored_total):
+            drift[key] = (expected_count - stored_count, expected_total - stored_total)
+    drifted_guild_ids = sorted({guild_id for guild_id, _ in drift.keys()})
+
+    if len(drift) > 0:
+        async with utils.db_transaction(db_connection) as db_cursor:
+            await apply_delta(db_cursor, drift)
+            await db_cursor.executemany(
+                "DELETE FROM balance_histogram WHERE guild_id = ? AND count = 0 AND total = 0",
+                [(guild_id,) for guild_id in drifted_guild_ids],
+            )
+
+    drift_repairs.increment(len(drifted_guild_ids))
+    if len(drifted_guild_ids) > 0:
+        logger.warning(
+            "Repaired the balance histograms of %d guilds that had drifted: %s.",
+            len(drifted_guild_ids),
+            ", ".join(str(guild_id) for guild_id in drifted_guild_ids),
+        )
+    logger.info(
+        "Checked balance histograms in %.2f s.", time.monotonic() - started_at
+    )
+
+    return len(drifted_guild_ids)
+
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List, Optional, Tuple, TypeVar
+
+import aiosqlite
+
+from bobux_economy import metrics, utils
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# How long to wait for more units after the first one in a batch, in
+# seconds.
+DEFAULT_WINDOW = 0.005
+
+# The maximum number of units committed together. A full batch is
+# committed without waiting for the rest of the window.
+DEFAULT_MAX_BATCH_SIZE = 64
+
+commits_saved = metrics.counter(
+    "db.group_commit.commits_saved",
+    "Commits avoided by running write units in a shared transaction.",
+)
+batches_committed = metrics.counter(
+    "db.group_commit.batches", "Shared transactions committed for write units."
+)
+
+WriteUnit = Callable[[aiosqlite.Cursor], Awaitable[Any]]
+
+
+class GroupCommit:
+    """
+    Runs independent write units in shared transactions, so that a burst
+    of small writes costs one commit instead of one each.
+
+    Each unit runs in its own savepoint, so a unit that raises is rolled
+    back on its own without affecting the rest of its batch. Callers are
+    only resumed once the shared transaction has been committed.
+
+    Units run in a separate task, so they must not rely on being inside a
+    transaction started by the caller. They should also avoid slow I/O
+    such as API calls, since the whole batch waits for them.
+    """
+
+    db_connection: aiosqlite.Connection
+    window: float
+    max_batch_size: int
+    _queue: "List[Tuple[WriteUnit, asyncio.Future[Any]]]"
+    _full: asyncio.Event
+    _flusher: "Optional[asyncio.Task[None]]"
+
+    def __init__(
+        self,
+        db_connection: aiosqlite.Connection,
+        *,
+        window: float = DEFAULT_WINDOW,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+    ):
+        """
+        Parameters
+        ----------
+        db_connection:  A connection to the SQLite database in use.
+        window:         How long to wait for more units after the first
+                        one in a batch, in seconds.
+        max_batch_size: The maximum number of units committed together.
+        """
+
+        self.db_connection = db_connection
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._queue = []
+        self._full = asyncio.Event()
+        self._flusher = None
+
+    async def run(self, unit: Callable[[aiosqlite.Cursor], Awaitable[T]]) -> T:
+        """
+        Run a write unit in the next shared transaction.
+
+        Parameters
+        ----------
+        unit: Called with a cursor inside the unit's savepoint.
+
+        Returns
+        -------
+        The result of the unit, once the transaction it ran in has been
+        committed.
+
+        Raises
+        ------
+        Exception: Whatever the unit raised, or the error that prevented
+                   the shared transaction from committing.
+        """
+
+        future: "asyncio.Future[T]" = asyncio.get_running_loop().create_future()
+        self._queue.append((unit, future))
+        if len(self._queue) >= self.max_batch_size:
+            self._full.set()
+
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+        return await future
+
+    async def _flush_loop(self):
+        try:
+            while len(self._queue) > 0:
+                if len(self._queue) < self.max_batch_size:
+                    self._full.clear()
+                    try:
+                        await asyncio.wait_for(self._full.wait(), self.window)
+                    except asyncio.TimeoutError:
+                        pass
+
+                batch = self._queue[: self.max_batch_size]
+                del self._queue[: self.max_batch_size]
+                await self._commit_batch(batch)
+        finally:
+            self._flusher = None
+
+    async def _commit_batch(self, batch: "List[Tuple[WriteUnit, asyncio.Future[Any]]]"):
+        # Callers that gave up while waiting don't need their units run.
+        batch = [(unit, future) for unit, future in batch if not future.done()]
+        if len(batch) == 0:
+            return
+
+        outcomes: List[Tuple["asyncio.Future[Any]", Any, Optional[BaseException]]] = []
+        try:
+            async with utils.db_transaction(self.db_connection):
+                for unit, future in batch:
+                    try:
+                        async with utils.db_transaction(self.db_connection) as db_cursor:
+                            result = await unit(db_cursor)
+                    except Exception as e:
+                        outcomes.append((future, None, e))
+                    else:
+                        outcomes.append((future, result, None))
+        except Exception as e:
+            logger.exception("Failed to commit a batch of %d write units.", len(batch))
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        batches_committed.increment()
+        commits_saved.increment(len(batch) - 1)
+
+        for future, result, exception in outcomes:
+            if future.done():
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
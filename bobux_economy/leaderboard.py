@@ -0,0 +1,157 @@
+"""
+Balance rankings within a guild, read one page at a time with keyset
+pagination so that no query touches more rows than it returns.
+
+Members are ordered by balance, highest first, with ties broken by
+descending user ID. Both queries here are served by the
+`members_guild_id_balance_id` index.
+"""
+
+from dataclasses import dataclass
+from typing import List, Optional
+
+import aiosqlite
+
+from bobux_economy import database
+from bobux_economy.bobux import Account, Bobux
+
+# The number of members shown on each leaderboard page.
+PAGE_SIZE = 20
+
+
+@dataclass(frozen=True)
+class LeaderboardEntry:
+    user_id: int
+    balance: Bobux
+
+
+async def get_page(
+    db_connection: aiosqlite.Connection,
+    guild_id: int,
+    *,
+    after: Optional[LeaderboardEntry] = None,
+    before: Optional[LeaderboardEntry] = None,
+    limit: int = PAGE_SIZE,
+) -> List[LeaderboardEntry]:
+    """
+    Get one page of the leaderboard for a guild.
+
+    Parameters
+    ----------
+    db_connection: A connection to the SQLite database in use.
+    guild_id:      The guild to get the leaderboard for.
+    after:         Get the page that comes right after this entry.
+    before:        Get the page that comes right before this entry.
+    limit:         The maximum number of entries on the page.
+
+    Returns
+    -------
+    The entries on the page, highest balance first. If neither `after`
+    nor `before` is given, this is the first page.
+    """
+
+    if after is not None and before is not None:
+        raise ValueError("Only one of 'after' and 'before' can be given")
+
+    async with database.read_cursor(db_connection) as db_cursor:
+        if before is not None:
+            # Walk the index backwards from the entry, then flip the
+            # page back into leaderboard order.
+            await db_cursor.execute(
+                """
+                SELECT
+                    id,
+                    balance
+                FROM
+                    members
+                WHERE
+                    guild_id = ?
+                    AND (balance, id) > (?, ?)
+                ORDER BY
+                    balance ASC,
+                    id ASC
+                LIMIT
+                    ?
+                """,
+                (guild_id, before.balance.halves, before.user_id, limit),
+            )
+            rows = list(reversed(await db_cursor.fetchall()))
+        elif after is not None:
+            await db_cursor.execute(
+                """
+                SELECT
+                    id,
+                    balance
+                FROM
+                    members
+                WHERE
+                    guild_id = ?
+                    AND (balance, id) < (?, ?)
+                ORDER BY
+                    balance DESC,
+                    id DESC
+                LIMIT
+                    ?
+                """,
+                (guild_id, after.balance.halves, after.user_id, limit),
+            )
+            rows = await db_cursor.fetchall()
+        else:
+            await db_cursor.execute(
+                """
+                SELECT
+                    id,
+                    balance
+                FROM
+                    members
+                WHERE
+                    guild_id = ?
+                ORDER BY
+                    balance DESC,
+                    id DESC
+                LIMIT
+                    ?
+                """,
+                (guild_id, limit),
+            )
+            rows = await db_cursor.fetchall()
+
+    return [
+        LeaderboardEntry(row["id"], Bobux.from_halves(row["balance"])) for row in rows
+    ]
+
+
+async def get_rank(db_connection: aiosqlite.Connection, account: Account) -> int:
+    """
+    Get the position of an account on the leaderboard for its guild.
+    Accounts with equal balances share a position.
+
+    Parameters
+    ----------
+    db_connection: A connection to the SQLite database in use.
+    account:       The account to get the position of.
+
+    Returns
+    -------
+    The position of the account, starting from 1.
+    """
+
+    balance = await account.get_balance(db_connection)
+
+    async with database.read_cursor(db_connection) as db_cursor:
+        await db_cursor.execute(
+            """
+            SELECT
+                COUNT(*)
+            FROM
+                members
+            WHERE
+                guild_id = ?
+                AND balance > ?
+            """,
+            (account.discord_guild_id, balance.halves),
+        )
+        row = await db_cursor.fetchone()
+        assert row is not None
+
+    return row[0] + 1
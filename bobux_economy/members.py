@@ -0,0 +1,153 @@
+import asyncio
+from collections import OrderedDict
+import time
+from typing import Dict, Optional, Tuple
+
+import disnake
+
+from bobux_economy import metrics
+
+# How long a fetched member is reused before fetching it again, in
+# seconds.
+DEFAULT_TTL = 300.0
+
+# How long a member that was not found is remembered as missing, in
+# seconds. Kept short so that someone who rejoins is noticed quickly.
+DEFAULT_NEGATIVE_TTL = 60.0
+
+# The maximum number of members and missing members remembered at once.
+DEFAULT_MAX_SIZE = 4096
+
+cache_hits = metrics.counter(
+    "members.cache_hits", "Member lookups answered without a REST call."
+)
+cache_misses = metrics.counter(
+    "members.cache_misses", "Member lookups that needed a REST call."
+)
+negative_hits = metrics.counter(
+    "members.negative_hits",
+    "Lookups of members known to be missing that skipped a failing REST call.",
+)
+fetches_coalesced = metrics.counter(
+    "members.fetches_coalesced",
+    "Lookups that waited on a fetch already in flight for the same member.",
+)
+
+
+class MemberResolver:
+    """
+    Looks up guild members, falling back to the API when they are not in
+    the gateway cache. The bot doesn't request the members intent, so
+    that cache is usually cold.
+
+    Fetched members are kept for a while, members that could not be
+    found are remembered for a shorter while, and concurrent lookups of
+    the same member share one request.
+    """
+
+    ttl: float
+    negative_ttl: float
+    max_size: int
+    _entries: "OrderedDict[Tuple[int, int], Tuple[float, Optional[disnake.Member]]]"
+    _in_flight: "Dict[Tuple[int, int], asyncio.Task[Optional[disnake.Member]]]"
+
+    def __init__(
+        self,
+        *,
+        ttl: float = DEFAULT_TTL,
+        negative_ttl: float = DEFAULT_NEGATIVE_TTL,
+        max_size: int = DEFAULT_MAX_SIZE,
+    ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._in_flight = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def resolve(
+        self, guild: disnake.Guild, member_id: int
+    ) -> Optional[disnake.Member]:
+        """
+        Get a member of a guild.
+
+        Parameters
+        ----------
+        guild:     The guild to look the member up in.
+        member_id: The ID of the member.
+
+        Returns
+        -------
+        The member, or None if they are not in the guild.
+
+        Raises
+        ------
+        disnake.HTTPException: Fetching the member failed for a reason
+                               other than them not being found.
+        """
+
+        member = guild.get_member(member_id)
+        if member is not None:
+            cache_hits.increment()
+            return member
+
+        key = (guild.id, member_id)
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, member = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                if member is None:
+                    negative_hits.increment()
+                else:
+                    cache_hits.increment()
+                return member
+            del self._entries[key]
+
+        task = self._in_flight.get(key)
+        if task is None:
+            cache_misses.increment()
+            task = asyncio.create_task(self._fetch(guild, member_id))
+            self._in_flight[key] = task
+        else:
+            fetches_coalesced.increment()
+
+        # Shielded so that one cancelled caller doesn't cancel the fetch
+        # for everyone else waiting on it.
+        return await asyncio.shield(task)
+
+    def invalidate(self, guild_id: int, member_id: int):
+        """
+        Forget anything remembered about a member, so that the next
+        lookup fetches them again.
+
+        Parameters
+        ----------
+        guild_id:  The guild the member is in.
+        member_id: The ID of the member.
+        """
+
+        self._entries.pop((guild_id, member_id), None)
+
+    async def _fetch(
+        self, guild: disnake.Guild, member_id: int
+    ) -> Optional[disnake.Member]:
+        key = (guild.id, member_id)
+        try:
+            try:
+                member: Optional[disnake.Member] = await guild.fetch_member(member_id)
+                ttl = self.ttl
+            except disnake.NotFound:
+                member = None
+                ttl = self.negative_ttl
+
+            self._entries[key] = (time.monotonic() + ttl, member)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+            return member
+        finally:
+            del self._in_flight[key]
@@ -0,0 +1,102 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+import logging
+from typing import Optional, Type, TypeVar
+
+import disnake
+
+
+logger = logging.getLogger(__name__)
+
+I = TypeVar("I", bound="MessageInfo")
+
+# Enough to cover every message that is still getting votes in a handful
+# of busy vote channels.
+DEFAULT_MAX_SIZE = 4096
+
+
+@dataclass(frozen=True)
+class MessageInfo:
+    """
+    The facts about a message that the voting pipeline needs, without
+    the rest of the `disnake.Message` object.
+    """
+
+    id: int
+    channel_id: int
+    guild_id: Optional[int]
+    author_id: int
+    webhook_id: Optional[int]
+    speech_bubble: bool
+
+    @classmethod
+    def from_message(cls: Type[I], message: disnake.Message) -> I:
+        return cls(
+            id=message.id,
+            channel_id=message.channel.id,
+            guild_id=message.guild.id if message.guild is not None else None,
+            author_id=message.author.id,
+            webhook_id=message.webhook_id,
+            speech_bubble=(
+                message.content.startswith("💬") or message.content.startswith("🗨️")
+            ),
+        )
+
+
+class MessageCache:
+    """
+    A bounded LRU cache of `MessageInfo` objects, keyed by message ID.
+
+    Entries must be evicted when the message is edited or deleted, since
+    either could change the cached facts.
+    """
+
+    max_size: int
+    _entries: "OrderedDict[int, MessageInfo]"
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, message_id: int) -> Optional[MessageInfo]:
+        info = self._entries.get(message_id)
+        if info is not None:
+            self._entries.move_to_end(message_id)
+        return info
+
+    def put(self, info: MessageInfo):
+        self._entries[info.id] = info
+        self._entries.move_to_end(info.id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def evict(self, message_id: int):
+        self._entries.pop(message_id, None)
+
+    async def get_or_fetch(
+        self, channel: disnake.abc.Messageable, message_id: int
+    ) -> MessageInfo:
+        """
+        Get the info for a message, fetching the message from Discord
+        only if it is not already cached.
+
+        Parameters
+        ----------
+        channel:    The channel the message was sent in.
+        message_id: The ID of the message.
+
+        Returns
+        -------
+        The info for the message.
+        """
+
+        info = self.get(message_id)
+        if info is None:
+            message = await channel.fetch_message(message_id)
+            info = MessageInfo.from_message(message)
+            self.put(info)
+            logger.debug("Fetched message %d into the message cache.", message_id)
+        return info
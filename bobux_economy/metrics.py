@@ -0,0 +1,94 @@
+"""
+Simple in-process counters for keeping an eye on the bot's performance.
+"""
+
+from typing import Callable, Dict, List
+
+
+class Counter:
+    """A named, monotonically increasing count."""
+
+    name: str
+    description: str
+    value: int
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def increment(self, amount: int = 1):
+        self.value += amount
+
+
+class Gauge:
+    """A named value that is read from a callback when it is reported."""
+
+    name: str
+    description: str
+    _read: Callable[[], float]
+
+    def __init__(self, name: str, description: str, read: Callable[[], float]):
+        self.name = name
+        self.description = description
+        self._read = read
+
+    @property
+    def value(self) -> float:
+        return self._read()
+
+
+_counters: Dict[str, Counter] = {}
+_gauges: Dict[str, Gauge] = {}
+
+
+def counter(name: str, description: str) -> Counter:
+    """
+    Get the counter with the given name, creating it if it does not
+    exist yet.
+
+    Parameters
+    ----------
+    name:        A unique, dotted name for the counter.
+    description: A short explanation of what the counter measures.
+
+    Returns
+    -------
+    The counter with the given name.
+    """
+
+    existing = _counters.get(name)
+    if existing is not None:
+        return existing
+
+    new_counter = Counter(name, description)
+    _counters[name] = new_counter
+    return new_counter
+
+
+def all_counters() -> List[Counter]:
+    return sorted(_counters.values(), key=lambda c: c.name)
+
+
+def gauge(name: str, description: str, read: Callable[[], float]) -> Gauge:
+    """
+    Register a gauge, replacing any existing gauge with the same name.
+
+    Parameters
+    ----------
+    name:        A unique, dotted name for the gauge.
+    description: A short explanation of what the gauge measures.
+    read:        Called to get the current value of the gauge.
+
+    Returns
+    -------
+    The new gauge.
+    """
+
+    new_gauge = Gauge(name, description, read)
+    _gauges[name] = new_gauge
+    return new_gauge
+
+
+def all_gauges() -> List[Gauge]:
+    return sorted(_gauges.values(), key=lambda g: g.name)
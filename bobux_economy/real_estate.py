@@ -3,15 +3,17 @@ from typing import cast, Dict, Optional, Union
 import aiosqlite
 import disnake
 
-from bobux_economy import balance
+from bobux_economy import database, transactions
 from bobux_economy import utils
+from bobux_economy.bobux import Account, Bobux
+from bobux_economy.transactions import TransferLeg
 from bobux_economy.utils import UserFacingError
 
 
 # PyCharm’s type checker is stupid and can’t figure out these enums.
 CHANNEL_PRICES = {
-    cast(disnake.ChannelType, disnake.ChannelType.text): (150, False),
-    cast(disnake.ChannelType, disnake.ChannelType.voice): (100, False)
+    cast(disnake.ChannelType, disnake.ChannelType.text): Bobux(150, False),
+    cast(disnake.ChannelType, disnake.ChannelType.voice): Bobux(100, False)
 }
 
 async def buy(db_connection: aiosqlite.Connection, channel_type: disnake.ChannelType, buyer: disnake.Member, name: str) -> disnake.abc.GuildChannel:
@@ -20,7 +22,8 @@ async def buy(db_connection: aiosqlite.Connection, channel_type: disnake.Channel
     except KeyError:
         raise UserFacingError(f"{channel_type.name.capitalize()} channels are not for sale")
 
-    await balance.subtract(db_connection, buyer, *price)
+    buyer_account = Account.from_member(buyer)
+    await transactions.create_transfer(db_connection, [TransferLeg(buyer_account, -price)])
 
     bot_is_administrator = buyer.guild.me.guild_permissions.administrator
 
@@ -38,7 +41,7 @@ async def buy(db_connection: aiosqlite.Connection, channel_type: disnake.Channel
         else:
             raise RuntimeError(f"Could not create {channel_type.name} channel")
     except disnake.Forbidden:
-        await balance.add(db_connection, buyer, *price)
+        await transactions.create_transfer(db_connection, [TransferLeg(buyer_account, price)])
         raise UserFacingError("The bot needs the Manage Channels permission for real estate")
 
     async with utils.db_transaction(db_connection) as db_cursor:
@@ -48,7 +51,7 @@ async def buy(db_connection: aiosqlite.Connection, channel_type: disnake.Channel
 
     return channel
 
-async def sell(db_connection: aiosqlite.Connection, channel: Union[disnake.TextChannel, disnake.VoiceChannel], seller: disnake.Member):
+async def sell(db_connection: aiosqlite.Connection, channel: Union[disnake.TextChannel, disnake.VoiceChannel], seller: disnake.Member) -> Bobux:
     async with utils.db_transaction(db_connection) as db_cursor:
         await db_cursor.execute("""
             SELECT owner_id FROM purchased_channels WHERE id = ?;
@@ -61,7 +64,7 @@ async def sell(db_connection: aiosqlite.Connection, channel: Union[disnake.TextC
             raise UserFacingError(f"Only the owner of {channel.mention} can sell it")
 
         try:
-            selling_price = balance.from_float(balance.to_float(*CHANNEL_PRICES[channel.type]) / 2)
+            selling_price = Bobux.from_halves(CHANNEL_PRICES[channel.type].halves // 2)
         except KeyError:
             raise UserFacingError(f"{channel.type.name.capitalize()} channels are not for sale, how did you get one?")
 
@@ -71,13 +74,14 @@ async def sell(db_connection: aiosqlite.Connection, channel: Union[disnake.TextC
             DELETE FROM purchased_channels WHERE id = ?;
         """, (channel.id, ))
 
-    await balance.add(db_connection, seller, *selling_price)
+        # Credited in the same database transaction as the deletion.
+        await transactions.create_transfer(db_connection, [TransferLeg(Account.from_member(seller), selling_price)])
 
     return selling_price
 
 
 async def get_category(db_connection: aiosqlite.Connection, guild: disnake.Guild) -> disnake.CategoryChannel:
-    async with db_connection.cursor() as db_cursor:
+    async with database.read_cursor(db_connection) as db_cursor:
         await db_cursor.execute("""
             SELECT real_estate_category FROM guilds WHERE id = ?;
         """, (guild.id, ))
@@ -1,77 +1,588 @@
 import asyncio
-from contextlib import suppress
-from datetime import datetime, time, timedelta
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+import functools
+import hashlib
 import logging
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
+import aiohttp
 import aiosqlite
 import disnake
 
-from bobux_economy import balance
+from bobux_economy import balance_cache, database, economy, metrics, transactions, utils
+from bobux_economy.bobux import Account, Bobux
 from bobux_economy.bot import BobuxEconomyBot
-from bobux_economy.transactions import InsufficientFunds
+from bobux_economy.config.guild_config import GuildConfig
+from bobux_economy.transactions import TransferLeg
 
 # Charge subscriptions every minute for testing purposes
 DEBUG_TIMING = False
 
-async def run(bot: BobuxEconomyBot):
-    while True:
-        if DEBUG_TIMING:
-            # Wait one minute
-            next_charge_datetime = datetime.now() + timedelta(minutes=1)
-            sleep_seconds = 60
-        else:
-            # Wait until next Monday at midnight local time
-            now = datetime.now()
-            today = now.date()
-            next_charge_date = today + timedelta(days=(0 - today.weekday()) % 7)
-            next_charge_datetime = datetime.combine(next_charge_date, time(0, 0, 0))
-            if next_charge_datetime <= now:
-                next_charge_datetime += timedelta(days=7)
-            sleep_seconds = (next_charge_datetime - now).total_seconds()
-        logging.info(f"Next subscriptions charge at {next_charge_datetime}, in {sleep_seconds} seconds")
-        await asyncio.sleep(sleep_seconds)
-
-        # Find all active subscriptions across all guilds
-        async with bot.db_connection.cursor() as db_cursor:
+# Billing cycles are numbered from the first Monday after the Unix epoch,
+# in local time. Each guild is charged once per cycle, at its own offset
+# from the start of the cycle.
+CYCLE_EPOCH = datetime(1970, 1, 5)
+CYCLE_LENGTH = timedelta(minutes=1) if DEBUG_TIMING else timedelta(weeks=1)
+
+# How often the billing job checks for guilds that are due. Offsets that
+# aren't configured are multiples of this, so that the guilds billed by
+# each check are spread evenly across the cycle.
+BILLING_CHECK_INTERVAL = (
+    timedelta(seconds=10) if DEBUG_TIMING else timedelta(minutes=5)
+)
+
+# The most billing cycles charged at once when catching up after the bot
+# was offline. Older missed cycles are skipped.
+MAX_CATCH_UP_CYCLES = 4
+
+# The most role removals in flight at once in each guild. Discord rate
+# limits role changes per guild, so more than this would only queue up in
+# the HTTP client.
+REVOCATION_CONCURRENCY = 4
+
+# How many times a role removal that failed on Discord's end is tried,
+# and how long to wait before the first retry, in seconds. The wait
+# doubles after each retry.
+REVOCATION_ATTEMPTS = 3
+REVOCATION_RETRY_DELAY = 1.0
+
+# The ID of the scheduler job that charges subscriptions.
+BILLING_JOB_ID = "bill_subscriptions"
+
+roles_revoked = metrics.counter(
+    "subscriptions.roles_revoked",
+    "Subscription roles removed from members who couldn't pay.",
+)
+revocation_failures = metrics.counter(
+    "subscriptions.revocation_failures",
+    "Subscription roles that couldn't be removed from members who couldn't pay.",
+)
+
+
+def cycle_at(moment: datetime) -> int:
+    """
+    Get the billing cycle that a moment falls in.
+
+    Parameters
+    ----------
+    moment: A naive datetime in local time.
+
+    Returns
+    -------
+    The number of the most recent billing cycle to start.
+    """
+
+    return (moment - CYCLE_EPOCH) // CYCLE_LENGTH
+
+
+def cycle_start(cycle: int) -> datetime:
+    return CYCLE_EPOCH + cycle * CYCLE_LENGTH
+
+
+def billing_offset(guild_id: int, offset_minutes: Optional[int] = None) -> timedelta:
+    """
+    Get how long after the start of each billing cycle a guild is
+    charged.
+
+    Parameters
+    ----------
+    guild_id:       The guild to get the offset of.
+    offset_minutes: The offset configured by the guild, if any.
+
+    Returns
+    -------
+    The configured offset, or else one derived from a hash of the guild
+    ID that stays the same between restarts.
+    """
+
+    if offset_minutes is not None:
+        return timedelta(minutes=offset_minutes) % CYCLE_LENGTH
+
+    digest = hashlib.blake2b(guild_id.to_bytes(8, "little"), digest_size=8).digest()
+    slots = CYCLE_LENGTH // BILLING_CHECK_INTERVAL
+    return int.from_bytes(digest, "little") % slots * BILLING_CHECK_INTERVAL
+
+
+async def _read_billing_offsets(db_cursor: aiosqlite.Cursor, guild_ids: Iterable[int]) -> Dict[int, timedelta]:
+    await db_cursor.execute("""
+        SELECT snowflake, billing_offset_minutes FROM guild_config
+        WHERE billing_offset_minutes IS NOT NULL;
+    """)
+    configured = {row["snowflake"]: row["billing_offset_minutes"] for row in await db_cursor.fetchall()}
+    return {guild_id: billing_offset(guild_id, configured.get(guild_id)) for guild_id in guild_ids}
+
+
+def schedule(bot: BobuxEconomyBot):
+    """
+    Register the billing job with the bot's scheduler, replacing it if it
+    already exists. The first check runs as soon as the scheduler starts,
+    which catches up on cycles that were missed while the bot was offline.
+
+    Parameters
+    ----------
+    bot: The bot to charge subscriptions for.
+    """
+
+    bot.scheduler.add_job(
+        bill_due,
+        "interval",
+        seconds=BILLING_CHECK_INTERVAL.total_seconds(),
+        args=(bot,),
+        id=BILLING_JOB_ID,
+        replace_existing=True,
+        next_run_time=datetime.now(),
+        # Charge late rather than not at all, and only once if several
+        # runs were missed.
+        misfire_grace_time=None,
+        coalesce=True,
+        max_instances=1,
+    )
+
+
+@dataclass(frozen=True)
+class Delinquency:
+    """
+    A subscription that could not be paid for in a billing run.
+    """
+
+    member_id: int
+    role_id: int
+    guild_id: int
+
+
+@dataclass(frozen=True)
+class BillingResult:
+    charged: int
+    delinquent: List[Delinquency]
+
+
+async def start_billing(db_cursor: aiosqlite.Cursor, guild_ids: List[int]):
+    """
+    Start recording billing cycles for guilds, unless they already are.
+    Their first charge is at their offset in the next cycle.
+
+    Parameters
+    ----------
+    db_cursor: A cursor inside the transaction that creates the guild's
+               subscriptions.
+    guild_ids: The guilds to start billing.
+    """
+
+    now = datetime.now()
+    offsets = await _read_billing_offsets(db_cursor, guild_ids)
+    await db_cursor.executemany("""
+        INSERT INTO billing_cycles (guild_id, last_billed_cycle) VALUES (?, ?)
+        ON CONFLICT (guild_id) DO NOTHING;
+    """, [(guild_id, cycle_at(now - offset)) for guild_id, offset in offsets.items()])
+
+
+async def set_billing_offset(db_connection: aiosqlite.Connection, guild_id: int, offset_minutes: Optional[int]):
+    """
+    Change when in each billing cycle a guild is charged. The cycle the
+    guild was last billed for is moved along with the offset, so that the
+    next charge is at least a whole cycle after the last one.
+
+    Parameters
+    ----------
+    db_connection:  A connection to the SQLite database in use.
+    guild_id:       The guild to change the offset of.
+    offset_minutes: The new offset in minutes after Monday midnight, or
+                    None to derive one from the guild ID.
+    """
+
+    async with utils.db_transaction(db_connection) as db_cursor:
+        old_offset = (await _read_billing_offsets(db_cursor, [guild_id]))[guild_id]
+        new_offset = billing_offset(guild_id, offset_minutes)
+        await GuildConfig(db_connection, disnake.Object(guild_id)).billing_offset_minutes.set(offset_minutes)
+
+        await db_cursor.execute("""
+            SELECT last_billed_cycle FROM billing_cycles WHERE guild_id = ?;
+        """, (guild_id,))
+        row = await db_cursor.fetchone()
+        if row is None:
+            return
+
+        # The first cycle whose charge at the new offset comes at least a
+        # whole cycle after the last charge, rounding up.
+        last_charge = cycle_start(row["last_billed_cycle"]) + old_offset
+        next_cycle = -((CYCLE_EPOCH + new_offset - last_charge - CYCLE_LENGTH) // CYCLE_LENGTH)
+        await db_cursor.execute("""
+            UPDATE billing_cycles SET last_billed_cycle = ? WHERE guild_id = ?;
+        """, (next_cycle - 1, guild_id))
+
+
+async def next_charge(db_connection: aiosqlite.Connection, guild_id: int) -> datetime:
+    """
+    Get when a guild's subscriptions will next be charged.
+
+    Parameters
+    ----------
+    db_connection: A connection to the SQLite database in use.
+    guild_id:      The guild to check.
+
+    Returns
+    -------
+    A naive datetime in local time. If it has already passed, the guild
+    will be charged at the next check.
+    """
+
+    async with database.read_cursor(db_connection) as db_cursor:
+        offset = (await _read_billing_offsets(db_cursor, [guild_id]))[guild_id]
+        await db_cursor.execute("""
+            SELECT last_billed_cycle FROM billing_cycles WHERE guild_id = ?;
+        """, (guild_id,))
+        row = await db_cursor.fetchone()
+
+    if row is not None:
+        last_billed_cycle = row["last_billed_cycle"]
+    else:
+        last_billed_cycle = cycle_at(datetime.now() - offset)
+    return cycle_start(last_billed_cycle + 1) + offset
+
+
+async def charge(db_connection: aiosqlite.Connection, due: Dict[int, int]) -> BillingResult:
+    """
+    Charge every member for all of their subscriptions in some guilds,
+    and record those guilds as billed for a cycle. Everything happens in
+    a single database transaction, without touching Discord.
+
+    A member with several subscriptions in one guild pays for them from
+    the oldest to the newest, and stops being charged at the first one
+    they can't afford. That subscription and every newer one are
+    delinquent.
+
+    Parameters
+    ----------
+    db_connection: A connection to the SQLite database in use.
+    due:           The billing cycle to charge each guild for, keyed by
+                   guild ID.
+
+    Returns
+    -------
+    The number of subscriptions paid for, and the ones that weren't.
+    """
+
+    async with utils.db_transaction(db_connection) as db_cursor:
+        await db_cursor.execute("""
+            CREATE TEMP TABLE billing_due (guild_id INTEGER PRIMARY KEY, cycle INTEGER NOT NULL);
+        """)
+        await db_cursor.executemany("""
+            INSERT INTO temp.billing_due VALUES (?, ?);
+        """, due.items())
+
+        # Decide who can pay against one snapshot of the balances, so the
+        # charges and the delinquent subscriptions can't disagree. The
+        # CROSS JOINs fix the join order, so that only the subscriptions
+        # of the guilds that are due are read, through the guild_id and
+        # role_id indexes, instead of a scan of every subscription.
+        await db_cursor.execute("""
+            CREATE TEMP TABLE billing_run AS
+            SELECT
+                member_subscriptions.member_id,
+                member_subscriptions.role_id,
+                billing_due.guild_id,
+                available_subscriptions.price,
+                SUM(available_subscriptions.price) OVER (
+                    PARTITION BY member_subscriptions.member_id, billing_due.guild_id
+                    ORDER BY member_subscriptions.subscribed_since, member_subscriptions.role_id
+                    ROWS UNBOUNDED PRECEDING
+                ) <= COALESCE(members.balance, 0) AS paid
+            FROM
+                temp.billing_due
+                CROSS JOIN available_subscriptions ON available_subscriptions.guild_id = billing_due.guild_id
+                CROSS JOIN member_subscriptions ON member_subscriptions.role_id = available_subscriptions.role_id
+                LEFT JOIN members ON members.id = member_subscriptions.member_id
+                AND members.guild_id = billing_due.guild_id;
+        """)
+
+        try:
+            await db_cursor.execute("""
+                SELECT
+                    member_id,
+                    guild_id,
+                    COUNT(*) AS subscriptions,
+                    SUM(price) AS total
+                FROM
+                    temp.billing_run
+                WHERE
+                    paid
+                GROUP BY
+                    member_id,
+                    guild_id;
+            """)
+            totals = {}
+            charged = 0
+            for row in await db_cursor.fetchall():
+                totals[(row["member_id"], row["guild_id"])] = row["total"]
+                charged += row["subscriptions"]
+
+            await db_cursor.execute("""
+                UPDATE members
+                SET
+                    balance = balance - charges.total
+                FROM
+                    (
+                        SELECT
+                            member_id,
+                            guild_id,
+                            SUM(price) AS total
+                        FROM
+                            temp.billing_run
+                        WHERE
+                            paid
+                        GROUP BY
+                            member_id,
+                            guild_id
+                    ) AS charges
+                WHERE
+                    members.id = charges.member_id
+                    AND members.guild_id = charges.guild_id
+                    AND charges.total != 0
+                RETURNING
+                    id,
+                    guild_id,
+                    balance;
+            """)
+            histogram_delta: economy.HistogramDelta = {}
+            for row in await db_cursor.fetchall():
+                key = (row["id"], row["guild_id"])
+                economy.add_balance_change(
+                    histogram_delta, row["guild_id"], row["balance"] + totals[key], row["balance"]
+                )
+                utils.after_commit(
+                    db_connection,
+                    functools.partial(balance_cache.balances.put, key, row["balance"]),
+                )
+            await economy.apply_delta(db_cursor, histogram_delta)
+
             await db_cursor.execute("""
-                SELECT member_id, member_subscriptions.role_id, guild_id, price, spare_change
-                    FROM member_subscriptions
-                    INNER JOIN available_subscriptions USING(role_id);
+                SELECT
+                    member_id,
+                    role_id,
+                    guild_id
+                FROM
+                    temp.billing_run
+                WHERE
+                    NOT paid;
             """)
-            results = await db_cursor.fetchall()
-
-        for row in results:
-            member_id: int = row["member_id"]
-            role_id: int = row["role_id"]
-            guild_id: int = row["guild_id"]
-            price: int = row["price"]
-            spare_change: bool = row["spare_change"]
-
-            guild = bot.get_guild(guild_id) or await bot.fetch_guild(guild_id)
-            member = guild.get_member(member_id) or await guild.fetch_member(member_id)
-
-            try:
-                await balance.subtract(bot.db_connection, member, price, spare_change)
-            except InsufficientFunds:
-                role = guild.get_role(role_id)
-                if role is not None:
-                    with suppress(disnake.Forbidden):
-                        await unsubscribe(bot.db_connection, member, role, reason="Insufficient funds for paid subscription")
-                    logging.info(f"Automatically unsubscribed @{member.display_name}#{member.discriminator} from ‘{role.name}’ due to insufficient funds.")
-
-
-async def subscribe(db_connection: aiosqlite.Connection, member: disnake.Member, role: disnake.Role, *, reason: str = "Subscribed to paid subscription"):
-    await member.add_roles(role, reason=reason)
-    async with db_connection.cursor() as db_cursor:
+            delinquent = [
+                Delinquency(row["member_id"], row["role_id"], row["guild_id"])
+                for row in await db_cursor.fetchall()
+            ]
+
+            await db_cursor.execute("""
+                UPDATE billing_cycles
+                SET
+                    last_billed_cycle = billing_due.cycle
+                FROM
+                    temp.billing_due
+                WHERE
+                    billing_cycles.guild_id = billing_due.guild_id;
+            """)
+        finally:
+            await db_cursor.execute("DROP TABLE temp.billing_run;")
+            await db_cursor.execute("DROP TABLE temp.billing_due;")
+
+    return BillingResult(charged, delinquent)
+
+
+async def bill_due(bot: BobuxEconomyBot):
+    """
+    Charge every guild that has reached its offset in a billing cycle it
+    hasn't been charged for yet, catching up on missed cycles one at a
+    time. Then remove the roles of members who couldn't pay.
+
+    Parameters
+    ----------
+    bot: The bot to charge subscriptions for.
+    """
+
+    started_at = datetime.now()
+
+    async with utils.db_transaction(bot.db_connection) as db_cursor:
+        # Guilds with subscriptions from before billing cycles were
+        # recorded start from their current cycle, instead of being
+        # charged for every week since the epoch.
+        await db_cursor.execute("""
+            SELECT DISTINCT guild_id FROM available_subscriptions
+            WHERE guild_id NOT IN (SELECT guild_id FROM billing_cycles);
+        """)
+        await start_billing(db_cursor, [row["guild_id"] for row in await db_cursor.fetchall()])
+
+        await db_cursor.execute("""
+            SELECT guild_id, last_billed_cycle FROM billing_cycles;
+        """)
+        last_billed_cycles = {row["guild_id"]: row["last_billed_cycle"] for row in await db_cursor.fetchall()}
+        offsets = await _read_billing_offsets(db_cursor, last_billed_cycles.keys())
+
+    # The cycle each guild has been charged up to, and the one it should
+    # have been.
+    pending: Dict[int, Tuple[int, int]] = {}
+    for guild_id, last_billed_cycle in last_billed_cycles.items():
+        current_cycle = cycle_at(started_at - offsets[guild_id])
+        if last_billed_cycle >= current_cycle:
+            continue
+        if current_cycle - last_billed_cycle > MAX_CATCH_UP_CYCLES:
+            logging.warning(f"Skipping {current_cycle - last_billed_cycle - MAX_CATCH_UP_CYCLES} billing cycles for guild {guild_id}, which were missed too long ago.")
+            last_billed_cycle = current_cycle - MAX_CATCH_UP_CYCLES
+        pending[guild_id] = (last_billed_cycle, current_cycle)
+
+    # Most checks find nothing to do.
+    if len(pending) == 0:
+        return
+
+    charged = 0
+    delinquent: Set[Delinquency] = set()
+    while len(pending) > 0:
+        due = {guild_id: last_billed_cycle + 1 for guild_id, (last_billed_cycle, _) in pending.items()}
+        result = await charge(bot.db_connection, due)
+        charged += result.charged
+        delinquent.update(result.delinquent)
+
+        pending = {
+            guild_id: (last_billed_cycle + 1, current_cycle)
+            for guild_id, (last_billed_cycle, current_cycle) in pending.items()
+            if last_billed_cycle + 1 < current_cycle
+        }
+        if len(pending) > 0:
+            logging.info(f"Catching up on missed billing cycles for {len(pending)} guilds.")
+
+    revoked = await revoke(bot, list(delinquent))
+
+    elapsed = (datetime.now() - started_at).total_seconds()
+    logging.info(f"Charged {charged} subscriptions, {len(delinquent)} could not be paid for and {revoked} of those were revoked, in {elapsed:.2f} seconds.")
+
+
+async def _revoke_one(bot: BobuxEconomyBot, delinquency: Delinquency, semaphore: asyncio.Semaphore) -> bool:
+    # Returns whether the subscription should be deleted. The semaphore is
+    # only held during requests, so that waiting to retry doesn't hold up
+    # other removals in the same guild.
+    delay = REVOCATION_RETRY_DELAY
+    for attempt in range(1, REVOCATION_ATTEMPTS + 1):
+        try:
+            async with semaphore:
+                await bot.http.remove_role(
+                    delinquency.guild_id,
+                    delinquency.member_id,
+                    delinquency.role_id,
+                    reason="Insufficient funds for paid subscription",
+                )
+        except disnake.NotFound:
+            # The member left, or the role or guild is gone, so there is
+            # no role left to remove.
+            logging.info(f"Member {delinquency.member_id} or role {delinquency.role_id} is no longer in guild {delinquency.guild_id}, deleting the subscription.")
+            return True
+        except disnake.Forbidden:
+            logging.warning(f"Missing permissions to remove role {delinquency.role_id} from member {delinquency.member_id} in guild {delinquency.guild_id}, keeping the subscription until the next billing cycle.")
+            revocation_failures.increment()
+            return False
+        except (disnake.DiscordServerError, aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            if attempt == REVOCATION_ATTEMPTS:
+                logging.warning(f"Failed to remove role {delinquency.role_id} from member {delinquency.member_id} in guild {delinquency.guild_id} after {attempt} attempts, keeping the subscription until the next billing cycle: {e}")
+                revocation_failures.increment()
+                return False
+            await asyncio.sleep(delay)
+            delay *= 2
+        except disnake.HTTPException as e:
+            logging.warning(f"Failed to remove role {delinquency.role_id} from member {delinquency.member_id} in guild {delinquency.guild_id}, keeping the subscription until the next billing cycle: {e}")
+            revocation_failures.increment()
+            return False
+        else:
+            roles_revoked.increment()
+            return True
+
+    return False
+
+
+async def revoke(bot: BobuxEconomyBot, delinquent: List[Delinquency]) -> int:
+    """
+    Remove the roles of subscriptions that couldn't be paid for, and
+    delete the subscriptions.
+
+    Role removals run concurrently, up to `REVOCATION_CONCURRENCY` at a
+    time in each guild, since Discord rate limits them per guild. A
+    removal that fails leaves its subscription in place to be tried
+    again next cycle, without holding up the others. The subscriptions
+    that are done with are deleted together at the end.
+
+    Parameters
+    ----------
+    bot:        The bot to remove roles with.
+    delinquent: The subscriptions to revoke.
+
+    Returns
+    -------
+    The number of subscriptions deleted.
+    """
+
+    semaphores: Dict[int, asyncio.Semaphore] = {}
+    results = await asyncio.gather(*(
+        _revoke_one(
+            bot,
+            delinquency,
+            semaphores.setdefault(delinquency.guild_id, asyncio.Semaphore(REVOCATION_CONCURRENCY)),
+        )
+        for delinquency in delinquent
+    ), return_exceptions=True)
+
+    # An unexpected error in one removal must not stop the subscriptions
+    # whose roles were already removed from being deleted.
+    revoked: List[Delinquency] = []
+    for delinquency, result in zip(delinquent, results):
+        if isinstance(result, BaseException):
+            logging.error(f"Failed to remove role {delinquency.role_id} from member {delinquency.member_id} in guild {delinquency.guild_id}, keeping the subscription until the next billing cycle.", exc_info=result)
+            revocation_failures.increment()
+        elif result:
+            revoked.append(delinquency)
+
+    async with utils.db_transaction(bot.db_connection) as db_cursor:
+        await db_cursor.executemany("""
+            DELETE FROM member_subscriptions WHERE member_id = ? AND role_id = ?;
+        """, [(delinquency.member_id, delinquency.role_id) for delinquency in revoked])
+
+    return len(revoked)
+
+
+async def subscribe(db_connection: aiosqlite.Connection, member: disnake.Member, role: disnake.Role, price: Bobux, *, reason: str = "Subscribed to paid subscription"):
+    """
+    Charge a member for the first week of a subscription and give them
+    the role.
+
+    The charge and the subscription are committed before the role is
+    added, so the write lock isn't held during the request to Discord. If
+    adding the role fails, the subscription is removed and the charge is
+    refunded in a second transaction before the error is raised.
+
+    Parameters
+    ----------
+    db_connection: The connection to write through.
+    member:        The member subscribing.
+    role:          The subscription role.
+    price:         The price of the first week.
+    reason:        The audit log reason for adding the role.
+    """
+
+    account = Account.from_member(member)
+    async with utils.db_transaction(db_connection) as db_cursor:
+        await transactions.create_transfer(db_connection, [TransferLeg(account, -price)])
         await db_cursor.execute("""
             INSERT INTO member_subscriptions VALUES (?, ?, ?);
         """, (member.id, role.id, datetime.utcnow()))
-        await db_connection.commit()
+
+    try:
+        await member.add_roles(role, reason=reason)
+    except Exception:
+        async with utils.db_transaction(db_connection) as db_cursor:
+            await db_cursor.execute("""
+                DELETE FROM member_subscriptions WHERE member_id = ? AND role_id = ?;
+            """, (member.id, role.id))
+            await transactions.create_transfer(db_connection, [TransferLeg(account, price)])
+        raise
 
 async def unsubscribe(db_connection: aiosqlite.Connection, member: disnake.Member, role: disnake.Role, *, reason: str = "Unsubscribed from paid subscription"):
     await member.remove_roles(role, reason=reason)
-    async with db_connection.cursor() as db_cursor:
+    async with utils.db_transaction(db_connection) as db_cursor:
         await db_cursor.execute("""
             DELETE FROM member_subscriptions WHERE member_id = ? AND role_id = ?;
         """, (member.id, role.id))
-        await db_connection.commit()
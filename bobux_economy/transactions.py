@@ -1,14 +1,19 @@
+from dataclasses import dataclass
+import functools
 import logging
-from typing import Optional
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 
 import aiosqlite
-from bobux_economy import utils
+from bobux_economy import balance_cache, economy, utils
 
 from bobux_economy.bobux import Account, Bobux
 
 
 logger = logging.getLogger(__name__)
 
+# The number of balances read per query when checking a bulk debit.
+BULK_READ_CHUNK_SIZE = 500
+
 
 class InsufficientFunds(utils.UserFacingError):
     amount_short: Bobux
@@ -23,12 +28,22 @@ class NegativeAmount(utils.UserFacingError):
         super().__init__("Negative transaction amounts are not allowed.")
 
 
+@dataclass(frozen=True)
+class TransferLeg:
+    """
+    One leg of a transfer: a signed change to the balance of a single
+    account. Positive amounts are credited and negative amounts are
+    debited.
+    """
+
+    account: Account
+    amount: Bobux
+    allow_overdraft: bool = False
+
 
-async def _set_balance_raw(
-    db_connection: aiosqlite.Connection, account: Account, balance: Bobux
-):
+async def _apply_leg(db_cursor: aiosqlite.Cursor, leg: TransferLeg) -> Bobux:
     """
-    Set the current balance of an account directly.
+    Apply one leg of a transfer with a single statement.
 
     This function does not commit the current database transaction,
     which allows it to be used as a building block for larger
@@ -38,31 +53,132 @@ async def _set_balance_raw(
 
     Parameters
     ----------
-    db_connection: A connection to the SQLite database in use.
-    account:       The account to update the balance of.
-    balance:       The new balance of the account.
+    db_cursor: A cursor on the SQLite database in use.
+    leg:       The balance change to apply.
+
+    Returns
+    -------
+    The new balance of the account.
+
+    Raises
+    ------
+    InsufficientFunds: The leg is a debit that would overdraw the
+                       account, and overdrafts are not allowed.
     """
 
-    async with db_connection.cursor() as db_cursor:
+    account = leg.account
+
+    if leg.amount < Bobux.ZERO and not leg.allow_overdraft:
+        # Only debit the account if it can cover the amount. An account
+        # without a row has a balance of zero, so it never can.
+        await db_cursor.execute(
+            """
+            UPDATE members
+            SET
+                balance = balance + ?
+            WHERE
+                id = ?
+                AND guild_id = ?
+                AND balance >= ?
+            RETURNING
+                balance
+            """,
+            (
+                leg.amount.halves,
+                account.discord_user_id,
+                account.discord_guild_id,
+                -leg.amount.halves,
+            ),
+        )
+        row = await db_cursor.fetchone()
+        if row is None:
+            await db_cursor.execute(
+                "SELECT balance FROM members WHERE id = ? AND guild_id = ?",
+                (account.discord_user_id, account.discord_guild_id),
+            )
+            row = await db_cursor.fetchone()
+            balance = Bobux.from_halves(row["balance"]) if row is not None else Bobux.ZERO
+            raise InsufficientFunds(-(balance + leg.amount))
+    else:
         await db_cursor.execute(
             """
             INSERT INTO
-                members (id, guild_id, balance, spare_change)
+                members (id, guild_id, balance)
             VALUES
-                (?, ?, ?, ?)
+                (?, ?, ?)
             ON CONFLICT (id, guild_id) DO
             UPDATE
             SET
-                balance = excluded.balance,
-                spare_change = excluded.spare_change
+                balance = balance + excluded.balance
+            RETURNING
+                balance
             """,
             (
                 account.discord_user_id,
                 account.discord_guild_id,
-                balance.amount,
-                balance.spare_change,
+                leg.amount.halves,
             ),
         )
+        row = await db_cursor.fetchone()
+
+    return Bobux.from_halves(row["balance"])
+
+
+async def _apply_legs(
+    db_connection: aiosqlite.Connection, legs: Sequence[TransferLeg]
+):
+    """
+    Apply the legs of a transfer in a single database transaction.
+
+    Intended only for use within the `transactions` module.
+
+    Parameters
+    ----------
+    db_connection: A connection to the SQLite database in use.
+    legs:          The balance changes to apply, in order.
+    """
+
+    async with utils.db_transaction(db_connection) as db_cursor:
+        histogram_delta: economy.HistogramDelta = {}
+        for leg in legs:
+            balance = await _apply_leg(db_cursor, leg)
+            economy.add_balance_change(
+                histogram_delta,
+                leg.account.discord_guild_id,
+                (balance - leg.amount).halves,
+                balance.halves,
+            )
+            key = (leg.account.discord_user_id, leg.account.discord_guild_id)
+            utils.after_commit(
+                db_connection,
+                functools.partial(balance_cache.balances.put, key, balance.halves),
+            )
+        await economy.apply_delta(db_cursor, histogram_delta)
+
+
+async def create_transfer(
+    db_connection: aiosqlite.Connection, legs: Iterable[TransferLeg]
+):
+    """
+    Apply several balance changes in a single database transaction.
+    Either every leg is applied or none of them are.
+
+    Legs do not need to sum to zero, which allows bobux to be created or
+    destroyed as part of a transfer.
+
+    Parameters
+    ----------
+    db_connection: A connection to the SQLite database in use.
+    legs:          The balance changes to apply, in order.
+    """
+
+    legs = list(legs)
+    await _apply_legs(db_connection, legs)
+
+    logger.info(
+        "Transfer: "
+        + ", ".join(f"{leg.amount} to {leg.account}" for leg in legs)
+    )
 
 
 async def create_transaction(
@@ -88,17 +204,130 @@ async def create_transaction(
     if amount < Bobux.ZERO:
         raise NegativeAmount()
 
-    async with utils.db_transaction(db_connection):
-        if source is not None:
-            source_balance = await source.get_balance(db_connection)
-            source_balance -= amount
-            if source_balance < Bobux.ZERO and not allow_overdraft:
-                raise InsufficientFunds(-source_balance)
-            await _set_balance_raw(db_connection, source, source_balance)
+    legs = []
+    if source is not None:
+        legs.append(TransferLeg(source, -amount, allow_overdraft))
+    if destination is not None:
+        legs.append(TransferLeg(destination, amount))
 
-        if destination is not None:
-            destination_balance = await destination.get_balance(db_connection)
-            destination_balance += amount
-            await _set_balance_raw(db_connection, destination, destination_balance)
+    await _apply_legs(db_connection, legs)
 
     logger.info(f"Transaction: {amount} from {source} to {destination}")
+
+
+async def _read_balances(
+    db_cursor: aiosqlite.Cursor, keys: Sequence[Tuple[int, int]]
+) -> Dict[Tuple[int, int], int]:
+    """
+    Read the balances of many accounts in half-bobux, a chunk at a time.
+    Accounts without a row are left out.
+    """
+
+    ids_by_guild: Dict[int, List[int]] = {}
+    for user_id, guild_id in keys:
+        ids_by_guild.setdefault(guild_id, []).append(user_id)
+
+    balances: Dict[Tuple[int, int], int] = {}
+    for guild_id, user_ids in ids_by_guild.items():
+        for start in range(0, len(user_ids), BULK_READ_CHUNK_SIZE):
+            chunk = user_ids[start : start + BULK_READ_CHUNK_SIZE]
+            placeholders = ", ".join("?" * len(chunk))
+            await db_cursor.execute(
+                f"""
+                SELECT
+                    id,
+                    balance
+                FROM
+                    members
+                WHERE
+                    guild_id = ?
+                    AND id IN ({placeholders})
+                """,
+                (guild_id, *chunk),
+            )
+            for row in await db_cursor.fetchall():
+                balances[(row["id"], guild_id)] = row["balance"]
+
+    return balances
+
+
+async def create_transactions_bulk(
+    db_connection: aiosqlite.Connection,
+    accounts: Iterable[Account],
+    amount: Bobux,
+    allow_overdraft: bool = False,
+) -> int:
+    """
+    Apply the same balance change to many accounts in a single database
+    transaction, using one batched statement.
+
+    Parameters
+    ----------
+    db_connection:   A connection to the SQLite database in use.
+    accounts:        The accounts to update. Duplicates are ignored.
+    amount:          The change to apply to each account. Positive
+                     amounts are credited and negative amounts are
+                     debited.
+    allow_overdraft: Whether to allow debits to take balances below
+                     zero.
+
+    Returns
+    -------
+    The number of accounts that were updated.
+
+    Raises
+    ------
+    InsufficientFunds: The amount is a debit that at least one account
+                       can't cover, and overdrafts are not allowed. No
+                       accounts are updated, and the shortfall is the
+                       largest of any account.
+    """
+
+    keys = list(
+        dict.fromkeys((a.discord_user_id, a.discord_guild_id) for a in accounts)
+    )
+    if len(keys) == 0:
+        return 0
+
+    async with utils.db_transaction(db_connection) as db_cursor:
+        # Accounts without a row have a balance of zero.
+        old_balances = await _read_balances(db_cursor, keys)
+
+        if amount < Bobux.ZERO and not allow_overdraft:
+            lowest_balance = Bobux.from_halves(
+                min(old_balances.get(key, 0) for key in keys)
+            )
+            if lowest_balance + amount < Bobux.ZERO:
+                raise InsufficientFunds(-(lowest_balance + amount))
+
+        await db_cursor.executemany(
+            """
+            INSERT INTO
+                members (id, guild_id, balance)
+            VALUES
+                (?, ?, ?)
+            ON CONFLICT (id, guild_id) DO
+            UPDATE
+            SET
+                balance = balance + excluded.balance
+            """,
+            [(user_id, guild_id, amount.halves) for user_id, guild_id in keys],
+        )
+
+        histogram_delta: economy.HistogramDelta = {}
+        for key in keys:
+            old_halves = old_balances.get(key, 0)
+            economy.add_balance_change(
+                histogram_delta, key[1], old_halves, old_halves + amount.halves
+            )
+        await economy.apply_delta(db_cursor, histogram_delta)
+
+        # The new balances aren't returned by a batched statement.
+        utils.after_commit(
+            db_connection,
+            functools.partial(balance_cache.balances.invalidate, keys),
+        )
+
+    logger.info(f"Bulk transaction: {amount} to {len(keys)} accounts")
+
+    return len(keys)
@@ -1,13 +1,18 @@
+from dataclasses import dataclass
 import enum
 import logging
-from typing import Dict, List, Optional, Tuple, Union
+import sqlite3
+from typing import Iterable, List, Optional, Sequence, Set, Tuple, Union
 
 import aiosqlite
 import disnake as disnake
 
-from bobux_economy import balance, utils
+from bobux_economy import database, metrics, transactions, utils, webhooks
+from bobux_economy.bobux import Account, Bobux
 from bobux_economy.bot import BobuxEconomyBot
 from bobux_economy.config.guild_config import GuildConfig
+from bobux_economy.message_cache import MessageInfo
+from bobux_economy.transactions import TransferLeg
 
 # TODO: Make these configurable.
 UPVOTE_EMOJI = "⬆️"
@@ -19,20 +24,25 @@ class Vote(enum.IntEnum):
     DOWNVOTE = -1
 
 
-async def message_eligible(
-    db_connection: aiosqlite.Connection, message: disnake.Message
+async def channel_eligible(
+    db_connection: aiosqlite.Connection, guild_id: Optional[int], channel_id: int
 ) -> bool:
-    if message.guild is None:
+    if guild_id is None:
         return False
 
-    in_vote_channel = await GuildConfig(
-        db_connection, message.guild
-    ).vote_channel_ids.contains(message.channel.id)
+    return await GuildConfig(
+        db_connection, disnake.Object(guild_id)
+    ).vote_channel_ids.contains(channel_id)
 
-    return (
-        in_vote_channel
-        and not message.content.startswith("💬")
-        and not message.content.startswith("🗨️")
+
+async def message_eligible(
+    db_connection: aiosqlite.Connection, message: Union[disnake.Message, MessageInfo]
+) -> bool:
+    if isinstance(message, disnake.Message):
+        message = MessageInfo.from_message(message)
+
+    return not message.speech_bubble and await channel_eligible(
+        db_connection, message.guild_id, message.channel_id
     )
 
 
@@ -43,39 +53,148 @@ async def add_reactions(message: Union[disnake.Message, disnake.PartialMessage])
     logging.info("Added upvote and downvote reactions to message %d.", message.id)
 
 
-recently_removed_reactions: List[Tuple[int, Vote, int]] = []
+# Reactions removed by the bot, as (message ID, vote, member ID), so that
+# the removal events Discord echoes back can be ignored. Entries expire
+# in case the echo never arrives.
+recently_removed_reactions: utils.ExpiringSet[
+    Tuple[int, Vote, int]
+] = utils.ExpiringSet(
+    ttl=60.0,
+    max_size=10000,
+    expired=metrics.counter(
+        "upvotes.removed_reaction_echoes_expired",
+        "Reaction removals by the bot that Discord never echoed back",
+    ),
+)
 
 
-async def _user_reacted(
-    message: disnake.Message,
-    user: Union[disnake.User, disnake.Member],
-    emoji: Union[disnake.Emoji, disnake.PartialEmoji, str],
-) -> bool:
-    for reaction in message.reactions:
-        if reaction.emoji == emoji:
-            async for reaction_user in reaction.users():
-                if reaction_user == user:
-                    return True
-    return False
+# Before stored votes were used, finding extra reactions meant fetching
+# the message and paging through the users of every vote reaction, which
+# is at least one REST call per reaction checked.
+reaction_rest_calls_avoided = metrics.counter(
+    "upvotes.reaction_rest_calls_avoided",
+    "Minimum REST calls saved by finding extra reactions from stored votes",
+)
 
 
 async def remove_extra_reactions(
-    message: disnake.Message,
-    user: Union[disnake.User, disnake.Member],
+    message: Union[disnake.Message, disnake.PartialMessage],
+    user: disnake.abc.Snowflake,
     vote: Optional[Vote],
+    reacted: Iterable[Optional[Vote]],
 ):
-    logging.info(
-        "Removed extra reactions on message %d for member '%s'.",
-        message.id,
-        user.display_name,
+    """
+    Remove the vote reactions of a member that do not match their vote.
+
+    Which reactions are present is decided from local state instead of
+    asking Discord.
+
+    Parameters
+    ----------
+    message: The message that was voted on.
+    user:    The member who voted.
+    vote:    The vote of the member, or None if they should not have a
+             vote on this message.
+    reacted: The votes the member is known to have reacted with, such as
+             their previously stored vote and the reaction that was just
+             added. None is ignored.
+    """
+
+    # One fetch of the message, plus one page of users for each
+    # reaction that would have been checked.
+    reaction_rest_calls_avoided.increment(1 + (2 if vote is None else 1))
+
+    extra_votes = {v for v in reacted if v is not None and v != vote}
+    for extra_vote in sorted(extra_votes, reverse=True):
+        emoji = UPVOTE_EMOJI if extra_vote == Vote.UPVOTE else DOWNVOTE_EMOJI
+        recently_removed_reactions.add((message.id, extra_vote, user.id))
+        await message.remove_reaction(emoji, user)
+
+    if len(extra_votes) > 0:
+        logging.info(
+            "Removed extra reactions on message %d for member %d.",
+            message.id,
+            user.id,
+        )
+
+
+def score_deltas(old: Optional[Vote], new: Optional[Vote]) -> Tuple[int, int, int]:
+    """
+    Get the changes to the upvote count, downvote count and net score of
+    a message caused by a member changing their vote.
+    """
+
+    return (
+        int(new == Vote.UPVOTE) - int(old == Vote.UPVOTE),
+        int(new == Vote.DOWNVOTE) - int(old == Vote.DOWNVOTE),
+        (new or 0) - (old or 0),
     )
 
-    if vote != Vote.UPVOTE and await _user_reacted(message, user, UPVOTE_EMOJI):
-        recently_removed_reactions.append((message.id, Vote.UPVOTE, user.id))
-        await message.remove_reaction(UPVOTE_EMOJI, user)
-    if vote != Vote.DOWNVOTE and await _user_reacted(message, user, DOWNVOTE_EMOJI):
-        recently_removed_reactions.append((message.id, Vote.DOWNVOTE, user.id))
-        await message.remove_reaction(DOWNVOTE_EMOJI, user)
+
+UPSERT_MESSAGE_SCORE_SQL = """
+    INSERT INTO
+        message_scores (message_id, channel_id, guild_id, author_id, upvotes, downvotes, score)
+    VALUES
+        (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (message_id) DO
+    UPDATE
+    SET
+        author_id = COALESCE(excluded.author_id, author_id),
+        upvotes = upvotes + excluded.upvotes,
+        downvotes = downvotes + excluded.downvotes,
+        score = score + excluded.score
+"""
+
+
+async def _update_message_score(
+    db_cursor: aiosqlite.Cursor,
+    message_id: int,
+    old: Optional[Vote],
+    new: Optional[Vote],
+    *,
+    channel_id: Optional[int] = None,
+    guild_id: Optional[int] = None,
+    author_id: Optional[int] = None,
+):
+    """
+    Apply a vote change to the tally in `message_scores`. This must be
+    run in the same database transaction as the change to `votes`.
+
+    If the channel and guild are not provided, a tally is only updated
+    if it already exists.
+    """
+
+    if old == new:
+        return
+
+    upvotes_delta, downvotes_delta, score_delta = score_deltas(old, new)
+
+    if channel_id is None or guild_id is None:
+        await db_cursor.execute(
+            """
+            UPDATE message_scores
+            SET
+                upvotes = upvotes + ?,
+                downvotes = downvotes + ?,
+                score = score + ?
+            WHERE
+                message_id = ?
+            """,
+            (upvotes_delta, downvotes_delta, score_delta, message_id),
+        )
+    else:
+        await db_cursor.execute(
+            UPSERT_MESSAGE_SCORE_SQL,
+            (
+                message_id,
+                channel_id,
+                guild_id,
+                author_id,
+                upvotes_delta,
+                downvotes_delta,
+                score_delta,
+            ),
+        )
 
 
 async def record_vote(
@@ -84,6 +203,9 @@ async def record_vote(
     channel_id: int,
     member_id: int,
     vote: Vote,
+    *,
+    guild_id: Optional[int] = None,
+    author_id: Optional[int] = None,
 ) -> Optional[Vote]:
     async with utils.db_transaction(bot.db_connection) as db_cursor:
         await db_cursor.execute(
@@ -104,6 +226,16 @@ async def record_vote(
             (message_id, channel_id, member_id, vote),
         )
 
+        await _update_message_score(
+            db_cursor,
+            message_id,
+            previous_vote,
+            vote,
+            channel_id=channel_id,
+            guild_id=guild_id,
+            author_id=author_id,
+        )
+
     logging.info(
         "Recorded %s by member %d on message %d.",
         vote.name.lower(),
@@ -143,215 +275,288 @@ async def delete_vote(
 
         previous_vote: Optional[Vote] = Vote(row["vote"]) if row is not None else None
 
-    logging.info(
-        "Removed vote by member %d on message %d, if it was %s.",
-        member_id,
-        message_id,
-        "an upvote" if check_equal_to == Vote.UPVOTE else "a downvote",
-    )
-
-    return previous_vote
-
+        await _update_message_score(db_cursor, message_id, previous_vote, None)
 
-async def _sync_message(bot: BobuxEconomyBot, message: disnake.Message):
-    async with utils.db_transaction(bot.db_connection) as db_cursor:
-        await db_cursor.execute(
-            """
-            SELECT member_id, vote FROM votes WHERE message_id = ? AND channel_id = ?;
-            """,
-            (message.id, message.channel.id),
+    if check_equal_to is None:
+        logging.info("Removed vote by member %d on message %d.", member_id, message_id)
+    else:
+        logging.info(
+            "Removed vote by member %d on message %d, if it was %s.",
+            member_id,
+            message_id,
+            "an upvote" if check_equal_to == Vote.UPVOTE else "a downvote",
         )
-        deleted_rows = await db_cursor.fetchall()
 
-        await db_cursor.execute(
-            """
-            DELETE FROM votes WHERE message_id = ? AND channel_id = ?;
-            """,
-            (message.id, message.channel.id),
-        )
-        previous_votes: Dict[int, Vote] = (
-            {row["member_id"]: Vote(row["vote"]) for row in deleted_rows}
-            if deleted_rows is not None
-            else {}
-        )
+    return previous_vote
 
-        await add_reactions(message)
 
-        for reaction in message.reactions:
-            if not isinstance(reaction.emoji, str):
-                continue
+async def top_messages(
+    db_connection: aiosqlite.Connection,
+    guild_id: int,
+    since_message_id: int,
+    *,
+    channel_id: Optional[int] = None,
+    limit: int = 10,
+) -> List[sqlite3.Row]:
+    """
+    Get the highest scoring messages from the stored tallies, without
+    asking Discord.
+
+    Parameters
+    ----------
+    db_connection:    A connection to the SQLite database in use.
+    guild_id:         The guild to get messages from.
+    since_message_id: Only include messages with an ID at least this
+                      large. Use `disnake.utils.time_snowflake` to turn
+                      a time into a message ID.
+    channel_id:       If provided, only include messages from this
+                      channel.
+    limit:            The maximum number of messages to return.
+
+    Returns
+    -------
+    Rows of `message_scores`, best first.
+    """
+
+    async with database.read_cursor(db_connection) as db_cursor:
+        if channel_id is None:
+            await db_cursor.execute(
+                """
+                SELECT * FROM message_scores
+                    WHERE guild_id = ? AND message_id >= ?
+                    ORDER BY score DESC, message_id DESC
+                    LIMIT ?
+                """,
+                (guild_id, since_message_id, limit),
+            )
+        else:
+            await db_cursor.execute(
+                """
+                SELECT * FROM message_scores
+                    WHERE channel_id = ? AND message_id >= ?
+                    ORDER BY score DESC, message_id DESC
+                    LIMIT ?
+                """,
+                (channel_id, since_message_id, limit),
+            )
+        return list(await db_cursor.fetchall())
+
+
+POSTER_REWARD = Bobux(5)
+VOTER_REWARD = Bobux(2, spare_change=True)
+
+
+def vote_reward_legs(
+    poster: Account, voter: Account, old: Optional[Vote], new: Optional[Vote]
+) -> List[TransferLeg]:
+    """
+    Get the balance changes caused by a member changing their vote on a
+    message.
+
+    Parameters
+    ----------
+    poster: The account of the original author of the message.
+    voter:  The account of the member who voted.
+    old:    The previous vote of the member, if any.
+    new:    The current vote of the member, if any.
+
+    Returns
+    -------
+    A leg for the poster followed by a leg for the voter, or nothing if
+    the vote did not change.
+    """
+
+    if old == new:
+        return []
+
+    old_value = old or 0
+    new_value = new or 0
+    difference = new_value - old_value
+
+    negative = difference < 0
+    vote_removed = new is None
+    poster_reward = POSTER_REWARD * abs(difference)
+    voter_reward = VOTER_REWARD * abs(difference)
+
+    if negative and not vote_removed:
+        return [
+            TransferLeg(poster, -poster_reward, allow_overdraft=True),
+            TransferLeg(voter, voter_reward),
+        ]
+    elif not negative and not vote_removed:
+        return [TransferLeg(poster, poster_reward), TransferLeg(voter, voter_reward)]
+    # Rewards for a removed vote are taken back even if they have already
+    # been spent, since the vote itself must be removed either way.
+    elif negative and vote_removed:
+        return [
+            TransferLeg(poster, -poster_reward, allow_overdraft=True),
+            TransferLeg(voter, -voter_reward, allow_overdraft=True),
+        ]
+    else:
+        return [
+            TransferLeg(poster, poster_reward),
+            TransferLeg(voter, -voter_reward, allow_overdraft=True),
+        ]
+
+
+@dataclass(frozen=True)
+class ReactionEvent:
+    """A vote reaction being added to or removed from a message."""
+
+    vote: Vote
+    added: bool
+
+
+@dataclass(frozen=True)
+class VoteTarget:
+    """The message and member that a batch of reaction events is for."""
+
+    message: MessageInfo
+    partial_message: disnake.PartialMessage
+    guild: disnake.Guild
+    member: disnake.abc.Snowflake
+
+    @property
+    def key(self) -> Tuple[int, int]:
+        return (self.message.id, self.member.id)
+
+
+reaction_events_coalesced = metrics.counter(
+    "upvotes.reaction_events_coalesced",
+    "Reaction events handled as part of a larger batch",
+)
+
+
+def fold_reaction_events(
+    vote: Optional[Vote], events: Iterable[ReactionEvent]
+) -> Tuple[Optional[Vote], Set[Vote]]:
+    """
+    Work out the result of a sequence of reaction events by one member.
+
+    Parameters
+    ----------
+    vote:   The stored vote of the member before the events.
+    events: The events, oldest first.
+
+    Returns
+    -------
+    The vote of the member after the events, and the vote reactions the
+    member has on the message.
+    """
+
+    reacted: Set[Vote] = {vote} if vote is not None else set()
+    for event in events:
+        if event.added:
+            reacted.add(event.vote)
+            vote = event.vote
+        else:
+            reacted.discard(event.vote)
+            if vote == event.vote:
+                vote = None
+
+    return vote, reacted
+
+
+async def apply_reaction_events(
+    bot: BobuxEconomyBot, target: VoteTarget, events: Sequence[ReactionEvent]
+):
+    """
+    Apply a batch of reaction events by one member on one message. The
+    batch is collapsed to its final vote, which is recorded and rewarded
+    atomically, in a transaction shared with other votes.
+
+    Batches for the same message and member must not run concurrently.
+
+    Parameters
+    ----------
+    bot:    The bot the events were received by.
+    target: The message and member the events are for.
+    events: The events, oldest first.
+    """
+
+    message = target.message
+    member_id = target.member.id
+
+    if len(events) > 1:
+        reaction_events_coalesced.increment(len(events))
+        logging.info(
+            "Coalesced %d reaction events by member %d on message %d.",
+            len(events),
+            member_id,
+            message.id,
+        )
 
-            vote = None
-            if reaction.emoji == UPVOTE_EMOJI:
-                vote = Vote.UPVOTE
-            elif reaction.emoji == DOWNVOTE_EMOJI:
-                vote = Vote.DOWNVOTE
+    poster = await get_original_author(bot, message, target.guild)
+    if poster is None:
+        return
 
-            if vote is None:
-                continue
-
-            async for user in reaction.users():
-                if user != bot.user:
-                    await record_vote(
-                        bot,
-                        message.id,
-                        message.channel.id,
-                        user.id,
-                        vote,
-                    )
-                    await give_vote_rewards_raw(
-                        bot,
-                        message.id,
-                        message.channel.id,
-                        user.id,
-                        previous_votes.get(user.id),
-                        vote,
-                    )
-
-
-async def sync_votes(bot: BobuxEconomyBot):
-    async with bot.db_connection.cursor() as db_cursor:
-        # c.execute("""
-        #     SELECT DISTINCT message_id, channel_id FROM votes;
-        # """)
-        # result: List[Tuple[int, int]] = c.fetchall()
-        # # TODO: Parallelize this.
-        # for message_id, channel_id in result:
-        #     channel = await bot.fetch_channel(channel_id)
-        #     message = await channel.fetch_message(message_id)
-        #     await _sync_message(message)
+    if member_id == poster.id:
+        # The poster voted on their own message.
+        _, reacted = fold_reaction_events(None, events)
+        await remove_extra_reactions(
+            target.partial_message, target.member, None, reacted
+        )
+        return
 
+    async def apply_vote(
+        db_cursor: aiosqlite.Cursor,
+    ) -> Tuple[Optional[Vote], Set[Vote]]:
         await db_cursor.execute(
             """
-            SELECT memes_channel, last_memes_message FROM guilds
-                WHERE memes_channel IS NOT NULL AND last_memes_message IS NOT NULL;
-            """
+            SELECT vote FROM votes WHERE message_id = ? AND member_id = ?;
+            """,
+            (message.id, member_id),
         )
-        result = await db_cursor.fetchall()
-
-    for row in result:
-        channel_id: int = row["memes_channel"]
-        last_memes_message: int = row["last_memes_message"]
-
-        channel = bot.get_channel(channel_id)
-        if isinstance(channel, disnake.abc.Messageable):
-            async for message in channel.history(
-                after=disnake.Object(last_memes_message)
-            ):
-                await _sync_message(bot, message)
-
-
-POSTER_REWARD = 5.0
-VOTER_REWARD = 2.5
-
-
-async def give_vote_rewards_raw(
-    bot: BobuxEconomyBot,
-    message_id: int,
-    channel_id: int,
-    member_id: int,
-    old: Optional[Vote],
-    new: Optional[Vote],
-):
-    channel = bot.get_channel(channel_id)
-    if not isinstance(channel, disnake.abc.Messageable) or not isinstance(
-        channel, disnake.abc.GuildChannel
-    ):
-        return
-    partial_message = channel.get_partial_message(message_id)
-    member = channel.guild.get_member(member_id) or await channel.guild.fetch_member(
-        member_id
-    )
-    if member is None:
-        logging.error(f"Member {member_id} not found in guild {channel.guild.id}!")
-        return
-    await give_vote_rewards(bot.db_connection, partial_message, member, old, new)
+        row = await db_cursor.fetchone()
+        previous_vote: Optional[Vote] = Vote(row["vote"]) if row is not None else None
 
+        vote, reacted = fold_reaction_events(previous_vote, events)
 
-async def give_vote_rewards(
-    db_connection: aiosqlite.Connection,
-    partial_message: disnake.PartialMessage,
-    member: disnake.Member,
-    old: Optional[Vote],
-    new: Optional[Vote],
-):
-    if old != new:
-        logging.info(f"{member.id} on {partial_message.id}: {old} -> {new}")
-
-        old_value = old or 0
-        new_value = new or 0
-        difference = new_value - old_value
-
-        negative = difference < 0
-        vote_removed = new is None
-        poster_reward = balance.from_float(POSTER_REWARD * abs(difference))
-        voter_reward = balance.from_float(VOTER_REWARD * abs(difference))
-
-        message = await partial_message.fetch()
-        poster = await get_original_author(db_connection, message, member.guild)
-        if poster is None:
-            logging.error(
-                f"Member {message.author.id} not found in guild {member.guild.id}!"
-            )
-            return
+        if vote != previous_vote:
+            if vote is None:
+                await delete_vote(bot, message.id, member_id)
+            else:
+                await record_vote(
+                    bot,
+                    message.id,
+                    message.channel_id,
+                    member_id,
+                    vote,
+                    guild_id=target.guild.id,
+                    author_id=poster.id,
+                )
 
-        if negative and not vote_removed:
-            await balance.subtract(
-                db_connection, poster, *poster_reward, allow_overdraft=True
-            )
-            await balance.add(db_connection, member, *voter_reward)
-            logging.info(
-                f"{member.id} on {partial_message.id}: -{poster_reward} bobux / {voter_reward} bobux"
-            )
-        elif not negative and not vote_removed:
-            await balance.add(db_connection, poster, *poster_reward)
-            await balance.add(db_connection, member, *voter_reward)
-            logging.info(
-                f"{member.id} on {partial_message.id}: {poster_reward} bobux / {voter_reward} bobux"
-            )
-        elif negative and vote_removed:
-            await balance.subtract(db_connection, poster, *poster_reward)
-            await balance.subtract(db_connection, member, *voter_reward)
-            logging.info(
-                f"{member.id} on {partial_message.id}: -{poster_reward} bobux / -{voter_reward} bobux"
+            legs = vote_reward_legs(
+                Account.from_member(poster),
+                Account(member_id, target.guild.id),
+                previous_vote,
+                vote,
             )
-        elif not negative and vote_removed:
-            await balance.add(db_connection, poster, *poster_reward)
-            await balance.subtract(db_connection, member, *voter_reward)
+            await transactions.create_transfer(bot.db_connection, legs)
             logging.info(
-                f"{member.id} on {partial_message.id}: {poster_reward} bobux / -{voter_reward} bobux"
+                f"{member_id} on {message.id}: {previous_vote} -> {vote}, "
+                f"{legs[0].amount} / {legs[1].amount}"
             )
 
+        return vote, reacted
+
+    vote, reacted = await bot.group_commit.run(apply_vote)
+
+    await remove_extra_reactions(target.partial_message, target.member, vote, reacted)
+
 
 async def get_original_author(
-    db_connection: aiosqlite.Connection, message: disnake.Message, guild: disnake.Guild
+    bot: BobuxEconomyBot, message: MessageInfo, guild: disnake.Guild
 ) -> Optional[disnake.Member]:
-    if isinstance(message.author, disnake.Member):
-        return message.author
+    member_id = message.author_id
 
-    try:
-        return guild.get_member(message.author.id) or await guild.fetch_member(
-            message.author.id
+    if message.webhook_id is not None:
+        # Relocated messages are sent by a webhook puppeting the original
+        # poster, so the author of the message is not a member.
+        puppeted_member_id = await webhooks.get_member_id(
+            bot.db_connection, message.webhook_id
         )
-    except disnake.NotFound:
-        # Could be a webhook, check for puppeting
-        if message.webhook_id is not None:
-            async with db_connection.cursor() as db_cursor:
-                await db_cursor.execute(
-                    """
-                    SELECT member_id FROM webhooks WHERE webhook_id = ?;
-                    """,
-                    (message.webhook_id,),
-                )
-                row = await db_cursor.fetchone()
-
-            if row is not None:
-                member_id: int = row["member_id"]
-                try:
-                    return guild.get_member(member_id) or await guild.fetch_member(
-                        member_id
-                    )
-                except disnake.NotFound:
-                    return None
-
-    return None
+        if puppeted_member_id is not None:
+            member_id = puppeted_member_id
+
+    return await bot.members.resolve(guild, member_id)
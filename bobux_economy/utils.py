@@ -1,13 +1,34 @@
+import asyncio
+from collections import OrderedDict
 from contextlib import asynccontextmanager
-from typing import AsyncIterator, Callable, TypeVar
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+import logging
+import time
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Generic,
+    Hashable,
+    List,
+    Optional,
+    TypeVar,
+)
+from weakref import WeakKeyDictionary
 
 import aiosqlite
 import disnake
 from disnake.ext import commands
 from disnake.ui import ActionRow, MessageUIComponent
 
+from bobux_economy import metrics
+
+
+logger = logging.getLogger(__name__)
 
 T = TypeVar("T")
+K = TypeVar("K", bound=Hashable)
 
 
 async def wait_for_component(
@@ -78,39 +99,246 @@ class UserFacingError(RuntimeError):
         super().__init__(message)
 
 
-_transaction_level: int = 0
+class ExpiringSet(Generic[K]):
+    """
+    A set whose entries expire after a fixed time to live. The number of
+    entries is capped, and the oldest entries are dropped first when the
+    cap is reached.
+
+    All operations are O(1) amortized.
+    """
+
+    ttl: float
+    max_size: int
+    expired: Optional[metrics.Counter]
+    _deadlines: "OrderedDict[K, float]"
+
+    def __init__(
+        self,
+        ttl: float,
+        max_size: int,
+        *,
+        expired: Optional[metrics.Counter] = None,
+    ):
+        """
+        Parameters
+        ----------
+        ttl:      How long entries last, in seconds.
+        max_size: The maximum number of entries.
+        expired:  A counter to increment whenever an entry is dropped
+                  without being consumed.
+        """
+
+        self.ttl = ttl
+        self.max_size = max_size
+        self.expired = expired
+        self._deadlines = OrderedDict()
+
+    def __len__(self) -> int:
+        self._prune()
+        return len(self._deadlines)
+
+    def __contains__(self, key: K) -> bool:
+        self._prune()
+        return key in self._deadlines
+
+    def add(self, key: K):
+        self._prune()
+
+        # Every entry has the same time to live, so keeping entries in
+        # insertion order also keeps them in order of expiry.
+        self._deadlines.pop(key, None)
+        self._deadlines[key] = time.monotonic() + self.ttl
+
+        while len(self._deadlines) > self.max_size:
+            self._deadlines.popitem(last=False)
+            self._count_expired()
+
+    def consume(self, key: K) -> bool:
+        """
+        Remove an entry if it is present.
+
+        Returns
+        -------
+        Whether the entry was present and had not expired.
+        """
+
+        self._prune()
+        return self._deadlines.pop(key, None) is not None
+
+    def _prune(self):
+        now = time.monotonic()
+        while len(self._deadlines) > 0:
+            key, deadline = next(iter(self._deadlines.items()))
+            if deadline > now:
+                break
+            del self._deadlines[key]
+            self._count_expired()
+
+    def _count_expired(self):
+        if self.expired is not None:
+            self.expired.increment()
+
+
+@dataclass
+class _TransactionState:
+    connection: aiosqlite.Connection
+    task: "Optional[asyncio.Task[Any]]"
+    level: int = 1
+    # Callbacks registered with `after_commit`, one list per level.
+    callbacks: List[List[Callable[[], None]]] = field(default_factory=lambda: [[]])
+
+
+# The transaction the current task is in, if any. Kept per task so that
+# unrelated handlers don't see each other's nesting.
+_transaction_state: ContextVar[Optional[_TransactionState]] = ContextVar(
+    "_transaction_state", default=None
+)
+
+# Top-level transactions on the same connection take turns, since SQLite
+# connections only support one transaction at a time.
+_write_locks: "WeakKeyDictionary[aiosqlite.Connection, asyncio.Lock]" = (
+    WeakKeyDictionary()
+)
+
+write_lock_waits = metrics.counter(
+    "db.write_lock_waits",
+    "Transactions that had to wait for another transaction to finish.",
+)
+write_lock_wait_ms = metrics.counter(
+    "db.write_lock_wait_ms",
+    "Total time spent waiting for other transactions to finish, in milliseconds.",
+)
+
+
+def _current_transaction(
+    db_connection: aiosqlite.Connection,
+) -> Optional[_TransactionState]:
+    # The transaction the current task holds on the given connection, if
+    # any.
+    state = _transaction_state.get()
+    if (
+        state is not None
+        and state.connection is db_connection
+        and state.task is asyncio.current_task()
+    ):
+        return state
+    return None
+
+
+def in_transaction(db_connection: aiosqlite.Connection) -> bool:
+    """
+    Check whether the current task is inside a transaction on the given
+    connection.
+    """
+
+    return _current_transaction(db_connection) is not None
+
+
+def after_commit(db_connection: aiosqlite.Connection, callback: Callable[[], None]):
+    """
+    Run a callback once the current transaction on the given connection
+    has been committed, or right away if there is no transaction. The
+    callback is dropped if the transaction, or the savepoint it was
+    registered in, is rolled back.
+
+    Use this to update in-memory state that mirrors the database, so
+    that uncommitted changes are never visible through it.
+
+    Parameters
+    ----------
+    db_connection: A connection to the SQLite database in use.
+    callback:      The function to call after the commit.
+    """
+
+    state = _current_transaction(db_connection)
+    if state is not None:
+        state.callbacks[-1].append(callback)
+    else:
+        callback()
+
+
+def _run_callbacks(callbacks: List[Callable[[], None]]):
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception:
+            # The transaction has already been committed, so there is
+            # nobody left to report this to.
+            logger.exception("After-commit callback %r failed.", callback)
 
 
 @asynccontextmanager
 async def db_transaction(
     db_connection: aiosqlite.Connection,
 ) -> AsyncIterator[aiosqlite.Cursor]:
-    # Keep track of the number of nested transactions.
-    global _transaction_level
-    _transaction_level += 1
+    """
+    Run the body in a database transaction, which is committed if the
+    body succeeds and rolled back if it raises.
 
-    try:
-        if _transaction_level > 1:
-            # Use savepoints for nested transactions.
-            await db_connection.execute(
-                f"SAVEPOINT nested_transaction_{_transaction_level}"
-            )
-            async with db_connection.cursor() as db_cursor:
-                yield db_cursor
-        else:
-            # Use regular transactions when no nesting is involved.
-            await db_connection.execute("BEGIN")
+    Transactions started inside another transaction in the same task use
+    savepoints, so they can be rolled back on their own. Tasks started
+    inside a transaction do not join it, and wait for it to finish
+    instead.
+
+    Parameters
+    ----------
+    db_connection: A connection to the SQLite database in use.
+    """
+
+    state = _current_transaction(db_connection)
+    if state is not None:
+        # Use savepoints for nested transactions.
+        state.level += 1
+        state.callbacks.append([])
+        savepoint = f"nested_transaction_{state.level}"
+        try:
+            await db_connection.execute(f"SAVEPOINT {savepoint}")
             async with db_connection.cursor() as db_cursor:
                 yield db_cursor
-                await db_connection.commit()
-    except:
-        if _transaction_level > 1:
-            await db_connection.execute(
-                f"ROLLBACK TO SAVEPOINT nested_transaction_{_transaction_level}"
-            )
+            await db_connection.execute(f"RELEASE SAVEPOINT {savepoint}")
+        except:
+            await db_connection.execute(f"ROLLBACK TO SAVEPOINT {savepoint}")
+            await db_connection.execute(f"RELEASE SAVEPOINT {savepoint}")
+            state.callbacks.pop()
+            raise
         else:
-            await db_connection.rollback()
+            # Callbacks from the savepoint now depend on the enclosing
+            # transaction instead.
+            released_callbacks = state.callbacks.pop()
+            state.callbacks[-1].extend(released_callbacks)
+        finally:
+            state.level -= 1
+        return
+
+    write_lock = _write_locks.get(db_connection)
+    if write_lock is None:
+        write_lock = asyncio.Lock()
+        _write_locks[db_connection] = write_lock
+
+    if write_lock.locked():
+        write_lock_waits.increment()
+        wait_started_at = time.monotonic()
+        await write_lock.acquire()
+        write_lock_wait_ms.increment(
+            round((time.monotonic() - wait_started_at) * 1000)
+        )
+    else:
+        await write_lock.acquire()
 
+    state = _TransactionState(db_connection, asyncio.current_task())
+    token = _transaction_state.set(state)
+    try:
+        # Use regular transactions when no nesting is involved.
+        await db_connection.execute("BEGIN")
+        async with db_connection.cursor() as db_cursor:
+            yield db_cursor
+            await db_connection.commit()
+    except:
+        await db_connection.rollback()
         raise
     finally:
-        _transaction_level -= 1
+        _transaction_state.reset(token)
+        write_lock.release()
+
+    _run_callbacks(state.callbacks[0])
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Generic, Hashable, List, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+K = TypeVar("K", bound=Hashable)
+C = TypeVar("C")
+E = TypeVar("E")
+
+# How long to wait for more events before handling a new burst, in
+# seconds. Reaction flip-flops from one member usually arrive well within
+# this window.
+DEFAULT_COALESCE_DELAY = 0.25
+
+
+class VoteDispatcher(Generic[K, C, E]):
+    """
+    Runs the events for each key one batch at a time, in the order they
+    were submitted. Events for different keys run concurrently.
+
+    Events that are submitted while a key is waiting or busy are handed
+    to the handler together in the next batch, so that the handler can
+    collapse them into a single change.
+    """
+
+    handler: Callable[[C, List[E]], Awaitable[None]]
+    coalesce_delay: float
+    _pending: Dict[K, Tuple[C, List[E]]]
+    _workers: Dict[K, "asyncio.Task[None]"]
+
+    def __init__(
+        self,
+        handler: Callable[[C, List[E]], Awaitable[None]],
+        *,
+        coalesce_delay: float = DEFAULT_COALESCE_DELAY,
+    ):
+        """
+        Parameters
+        ----------
+        handler:        Called with the most recent context for a key
+                        and every event in a batch, oldest first.
+        coalesce_delay: How long to wait for more events before handling
+                        the first event of a burst, in seconds.
+        """
+
+        self.handler = handler
+        self.coalesce_delay = coalesce_delay
+        self._pending = {}
+        self._workers = {}
+
+    def submit(self, key: K, context: C, event: E):
+        """
+        Queue an event to be handled after every event submitted before
+        it with the same key.
+
+        Parameters
+        ----------
+        key:     Events with equal keys are handled in order.
+        context: Passed to the handler. Only the most recent context for
+                 a batch is used.
+        event:   The event to queue.
+        """
+
+        _, events = self._pending.get(key, (context, []))
+        events.append(event)
+        self._pending[key] = (context, events)
+
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._run(key))
+
+    async def _run(self, key: K):
+        try:
+            while key in self._pending:
+                await asyncio.sleep(self.coalesce_delay)
+
+                context, events = self._pending.pop(key)
+                try:
+                    await self.handler(context, events)
+                except Exception:
+                    logger.exception("Failed to handle events for %s.", key)
+        finally:
+            del self._workers[key]
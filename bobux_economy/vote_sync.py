@@ -0,0 +1,327 @@
+"""
+Resynchronization of stored votes with the reactions on Discord, used to
+catch up on votes that were cast while the bot was offline.
+"""
+
+import asyncio
+from dataclasses import dataclass, field
+import logging
+import time
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple, Union
+
+import disnake
+
+from bobux_economy import transactions, upvotes, utils
+from bobux_economy.bobux import Account, Bobux
+from bobux_economy.bot import BobuxEconomyBot
+from bobux_economy.message_cache import MessageInfo
+from bobux_economy.transactions import TransferLeg
+from bobux_economy.upvotes import Vote
+
+logger = logging.getLogger(__name__)
+
+# The number of vote channels whose history is scanned at the same time.
+SYNC_CONCURRENCY = 4
+
+# Progress is logged every time this many messages have been processed.
+PROGRESS_INTERVAL = 100
+
+# The number of recent messages scanned in a vote channel that has no
+# checkpoint yet, such as one added while the bot was offline.
+UNCHECKPOINTED_SCAN_LIMIT = 1000
+
+
+@dataclass
+class SyncProgress:
+    channels_total: int
+    channels_done: int = 0
+    messages: int = 0
+    votes_changed: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+
+    def log(self, prefix: str):
+        elapsed = time.monotonic() - self.started_at
+        rate = self.messages / elapsed if elapsed > 0 else 0.0
+        logger.info(
+            "%s: %d/%d channels, %d messages, %d votes changed in %.1f s (%.1f messages/s).",
+            prefix,
+            self.channels_done,
+            self.channels_total,
+            self.messages,
+            self.votes_changed,
+            elapsed,
+            rate,
+        )
+
+
+def _emoji_vote(
+    emoji: Union[disnake.Emoji, disnake.PartialEmoji, str]
+) -> Optional[Vote]:
+    if emoji == upvotes.UPVOTE_EMOJI:
+        return Vote.UPVOTE
+    elif emoji == upvotes.DOWNVOTE_EMOJI:
+        return Vote.DOWNVOTE
+    else:
+        return None
+
+
+async def _add_missing_reactions(message: disnake.Message):
+    for emoji in (upvotes.UPVOTE_EMOJI, upvotes.DOWNVOTE_EMOJI):
+        if not any(r.me and r.emoji == emoji for r in message.reactions):
+            await message.add_reaction(emoji)
+
+
+async def _fetch_votes(
+    bot: BobuxEconomyBot, message: disnake.Message
+) -> Dict[int, Vote]:
+    """
+    Get the current vote of every member who reacted to a message,
+    according to Discord.
+    """
+
+    votes: Dict[int, Vote] = {}
+    for reaction in message.reactions:
+        vote = _emoji_vote(reaction.emoji)
+        if vote is None:
+            continue
+        # Don't page through the users if the only reaction is ours.
+        if reaction.count <= (1 if reaction.me else 0):
+            continue
+
+        async for user in reaction.users():
+            if user.id != bot.user.id:
+                votes[user.id] = vote
+
+    return votes
+
+
+async def _sync_message(
+    bot: BobuxEconomyBot, message: disnake.Message, guild: disnake.Guild
+) -> int:
+    """
+    Bring the stored votes and rewards for a message in line with its
+    reactions. Every change is applied in a single database transaction.
+
+    Returns
+    -------
+    The number of votes that were inserted, changed or removed.
+    """
+
+    message_info = MessageInfo.from_message(message)
+    bot.message_cache.put(message_info)
+
+    await _add_missing_reactions(message)
+
+    poster = await upvotes.get_original_author(bot, message_info, guild)
+    fetched_votes = await _fetch_votes(bot, message)
+    if poster is not None:
+        # Votes on your own message are removed as soon as they are
+        # cast, so they never count.
+        fetched_votes.pop(poster.id, None)
+
+    async with utils.db_transaction(bot.db_connection) as db_cursor:
+        await db_cursor.execute(
+            """
+            SELECT member_id, vote FROM votes WHERE message_id = ?;
+            """,
+            (message.id,),
+        )
+        stored_votes: Dict[int, Vote] = {
+            row["member_id"]: Vote(row["vote"]) for row in await db_cursor.fetchall()
+        }
+
+        changed_member_ids = [
+            member_id
+            for member_id in stored_votes.keys() | fetched_votes.keys()
+            if stored_votes.get(member_id) != fetched_votes.get(member_id)
+        ]
+        if len(changed_member_ids) == 0:
+            return 0
+
+        await db_cursor.executemany(
+            """
+            INSERT INTO votes(message_id, channel_id, member_id, vote) VALUES (?, ?, ?, ?)
+                ON CONFLICT(message_id, member_id) DO UPDATE SET vote = excluded.vote;
+            """,
+            [
+                (message.id, message.channel.id, member_id, fetched_votes[member_id])
+                for member_id in changed_member_ids
+                if member_id in fetched_votes
+            ],
+        )
+        await db_cursor.executemany(
+            """
+            DELETE FROM votes WHERE message_id = ? AND member_id = ?;
+            """,
+            [
+                (message.id, member_id)
+                for member_id in changed_member_ids
+                if member_id not in fetched_votes
+            ],
+        )
+
+        upvotes_delta, downvotes_delta, score_delta = 0, 0, 0
+        for member_id in changed_member_ids:
+            deltas = upvotes.score_deltas(
+                stored_votes.get(member_id), fetched_votes.get(member_id)
+            )
+            upvotes_delta += deltas[0]
+            downvotes_delta += deltas[1]
+            score_delta += deltas[2]
+        await db_cursor.execute(
+            upvotes.UPSERT_MESSAGE_SCORE_SQL,
+            (
+                message.id,
+                message.channel.id,
+                guild.id,
+                poster.id if poster is not None else None,
+                upvotes_delta,
+                downvotes_delta,
+                score_delta,
+            ),
+        )
+
+        if poster is not None:
+            # Combine the rewards for every changed vote into one leg per
+            # account. Overdrafts are allowed since these votes have
+            # already happened.
+            poster_account = Account.from_member(poster)
+            rewards: Dict[Tuple[int, int], Bobux] = {}
+            for member_id in changed_member_ids:
+                for leg in upvotes.vote_reward_legs(
+                    poster_account,
+                    Account(member_id, guild.id),
+                    stored_votes.get(member_id),
+                    fetched_votes.get(member_id),
+                ):
+                    key = (leg.account.discord_user_id, leg.account.discord_guild_id)
+                    rewards[key] = rewards.get(key, Bobux.ZERO) + leg.amount
+
+            await transactions.create_transfer(
+                bot.db_connection,
+                [
+                    TransferLeg(Account(*key), amount, allow_overdraft=True)
+                    for key, amount in rewards.items()
+                    if amount != Bobux.ZERO
+                ],
+            )
+
+    return len(changed_member_ids)
+
+
+async def _sync_channel(
+    bot: BobuxEconomyBot,
+    guild_id: int,
+    channel_id: int,
+    after_message_id: Optional[int],
+    semaphore: asyncio.Semaphore,
+    progress: SyncProgress,
+):
+    async with semaphore:
+        try:
+            channel = bot.get_channel(channel_id)
+            if not isinstance(channel, disnake.abc.Messageable) or not isinstance(
+                channel, disnake.abc.GuildChannel
+            ):
+                logger.warning("Vote channel %d not found, skipping.", channel_id)
+                return
+
+            if after_message_id is not None:
+                messages = channel.history(
+                    limit=None, after=disnake.Object(after_message_id)
+                )
+            else:
+                # Without a checkpoint, only recent history is scanned.
+                # It is read newest first, so reverse it to advance the
+                # checkpoint in order.
+                recent = [
+                    message
+                    async for message in channel.history(
+                        limit=UNCHECKPOINTED_SCAN_LIMIT
+                    )
+                ]
+                messages = _iterate(reversed(recent))
+
+            async for message in messages:
+                if message.author == bot.user or not await upvotes.message_eligible(
+                    bot.db_connection, message
+                ):
+                    continue
+
+                progress.votes_changed += await _sync_message(
+                    bot, message, channel.guild
+                )
+                bot.vote_checkpoints.record(guild_id, channel_id, message.id)
+                progress.messages += 1
+                if progress.messages % PROGRESS_INTERVAL == 0:
+                    progress.log("Synchronizing votes")
+        except Exception:
+            # One broken channel must not cancel the others in the
+            # gather.
+            logger.exception("Failed to synchronize votes in channel %d.", channel_id)
+        finally:
+            progress.channels_done += 1
+
+
+async def _iterate(messages: Iterable[disnake.Message]) -> AsyncIterator[disnake.Message]:
+    for message in messages:
+        yield message
+
+
+async def _get_vote_channels(
+    bot: BobuxEconomyBot,
+) -> List[Tuple[int, int, Optional[int]]]:
+    """
+    Get every configured vote channel, as tuples of the guild ID, the
+    channel ID and the ID of the last message seen in it, or None if the
+    channel has no checkpoint yet.
+    """
+
+    async with bot.db_connection.cursor() as db_cursor:
+        await db_cursor.execute(
+            """
+            SELECT
+                vote_channels.snowflake AS guild_id,
+                vote_channels.value AS channel_id,
+                checkpoints.last_message_id
+            FROM
+                guild_config_vote_channel_ids AS vote_channels
+                LEFT JOIN vote_channel_checkpoints AS checkpoints ON checkpoints.guild_id = vote_channels.snowflake
+                AND checkpoints.channel_id = vote_channels.value
+            """
+        )
+        return [
+            (row["guild_id"], row["channel_id"], row["last_message_id"])
+            for row in await db_cursor.fetchall()
+        ]
+
+
+async def sync_votes(bot: BobuxEconomyBot, *, concurrency: int = SYNC_CONCURRENCY):
+    """
+    Synchronize the stored votes in every vote channel with the
+    reactions on Discord, starting after the checkpoint of each channel.
+    Channels without a checkpoint have their most recent messages
+    scanned instead. Checkpoints are advanced as messages are
+    synchronized.
+
+    Parameters
+    ----------
+    bot:         The bot to synchronize votes for.
+    concurrency: The maximum number of channels to scan at once.
+    """
+
+    vote_channels = await _get_vote_channels(bot)
+    progress = SyncProgress(channels_total=len(vote_channels))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    await asyncio.gather(
+        *(
+            _sync_channel(
+                bot, guild_id, channel_id, last_message_id, semaphore, progress
+            )
+            for guild_id, channel_id, last_message_id in vote_channels
+        )
+    )
+
+    progress.log("Finished synchronizing votes")
+    await bot.vote_checkpoints.flush()
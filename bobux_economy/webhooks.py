@@ -0,0 +1,86 @@
+"""
+The association between relocation webhooks and the members they puppet.
+
+The `webhooks` table is append-only, so once it has been loaded into
+memory the copy here never needs to be invalidated.
+"""
+
+import functools
+from typing import Dict, Optional
+
+import aiosqlite
+
+from bobux_economy import utils
+
+
+_member_ids: Dict[int, int] = {}
+_loaded: bool = False
+
+
+async def load(db_connection: aiosqlite.Connection):
+    """
+    Load every webhook into memory. Should be called once at startup.
+
+    Parameters
+    ----------
+    db_connection: A connection to the SQLite database in use.
+    """
+
+    global _member_ids, _loaded
+
+    async with db_connection.cursor() as db_cursor:
+        await db_cursor.execute("SELECT webhook_id, member_id FROM webhooks")
+        _member_ids = {
+            row["webhook_id"]: row["member_id"] for row in await db_cursor.fetchall()
+        }
+    _loaded = True
+
+
+async def get_member_id(
+    db_connection: aiosqlite.Connection, webhook_id: int
+) -> Optional[int]:
+    """
+    Get the ID of the member that a webhook was created to puppet.
+
+    Parameters
+    ----------
+    db_connection: A connection to the SQLite database in use.
+    webhook_id:    The ID of the webhook.
+
+    Returns
+    -------
+    The ID of the member, or None if the webhook was not created by the
+    bot.
+    """
+
+    if _loaded:
+        return _member_ids.get(webhook_id)
+
+    async with db_connection.cursor() as db_cursor:
+        await db_cursor.execute(
+            "SELECT member_id FROM webhooks WHERE webhook_id = ?", (webhook_id,)
+        )
+        row = await db_cursor.fetchone()
+        return row["member_id"] if row is not None else None
+
+
+async def record(db_connection: aiosqlite.Connection, webhook_id: int, member_id: int):
+    """
+    Permanently associate a webhook with the member it puppets.
+
+    Parameters
+    ----------
+    db_connection: A connection to the SQLite database in use.
+    webhook_id:    The ID of the webhook.
+    member_id:     The ID of the member.
+    """
+
+    async with utils.db_transaction(db_connection) as db_cursor:
+        await db_cursor.execute(
+            "INSERT INTO webhooks VALUES(?, ?)", (webhook_id, member_id)
+        )
+        if _loaded:
+            utils.after_commit(
+                db_connection,
+                functools.partial(_member_ids.__setitem__, webhook_id, member_id),
+            )
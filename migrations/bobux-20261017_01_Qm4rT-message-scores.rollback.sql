@@ -0,0 +1,4 @@
+-- Message scores
+-- depends: bobux-20230727_01_xYXEa-multiple-vote-channels
+
+DROP TABLE message_scores;
@@ -0,0 +1,36 @@
+-- Message scores
+-- depends: bobux-20230727_01_xYXEa-multiple-vote-channels
+
+-- Running vote tallies per message, maintained in the same transaction as
+-- every change to the votes table.
+CREATE TABLE
+    message_scores (
+        message_id INTEGER NOT NULL PRIMARY KEY,
+        channel_id INTEGER NOT NULL,
+        guild_id INTEGER NOT NULL,
+        -- The original poster, which may be unknown for old messages.
+        author_id INTEGER,
+        upvotes INTEGER NOT NULL DEFAULT 0,
+        downvotes INTEGER NOT NULL DEFAULT 0,
+        score INTEGER NOT NULL DEFAULT 0
+    );
+
+-- Message IDs are snowflakes, so these also serve time window queries.
+CREATE INDEX message_scores_guild_id_message_id ON message_scores (guild_id, message_id);
+
+CREATE INDEX message_scores_channel_id_message_id ON message_scores (channel_id, message_id);
+
+INSERT INTO
+    message_scores (message_id, channel_id, guild_id, upvotes, downvotes, score)
+SELECT
+    votes.message_id,
+    votes.channel_id,
+    vote_channels.snowflake,
+    SUM(votes.vote = 1),
+    SUM(votes.vote = -1),
+    SUM(votes.vote)
+FROM
+    votes
+    INNER JOIN guild_config_vote_channel_ids AS vote_channels ON vote_channels.value = votes.channel_id
+GROUP BY
+    votes.message_id;
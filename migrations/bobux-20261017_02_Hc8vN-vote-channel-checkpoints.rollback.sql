@@ -0,0 +1,4 @@
+-- Vote channel checkpoints
+-- depends: bobux-20261017_01_Qm4rT-message-scores
+
+DROP TABLE vote_channel_checkpoints;
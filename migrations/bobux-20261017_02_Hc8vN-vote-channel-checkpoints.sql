@@ -0,0 +1,24 @@
+-- Vote channel checkpoints
+-- depends: bobux-20261017_01_Qm4rT-message-scores
+
+-- The last message seen in each vote channel, so that votes can be
+-- synchronized from that point after a restart.
+CREATE TABLE
+    vote_channel_checkpoints (
+        channel_id INTEGER NOT NULL PRIMARY KEY,
+        guild_id INTEGER NOT NULL,
+        last_message_id INTEGER NOT NULL
+    );
+
+-- Start every vote channel from the old per-guild checkpoint.
+INSERT INTO
+    vote_channel_checkpoints (channel_id, guild_id, last_message_id)
+SELECT
+    vote_channels.value,
+    vote_channels.snowflake,
+    guilds.last_memes_message
+FROM
+    guild_config_vote_channel_ids AS vote_channels
+    INNER JOIN guilds ON guilds.id = vote_channels.snowflake
+WHERE
+    guilds.last_memes_message IS NOT NULL;
@@ -0,0 +1,18 @@
+-- Half-bobux balances
+-- depends: bobux-20261017_02_Hc8vN-vote-channel-checkpoints
+
+ALTER TABLE available_subscriptions
+ADD COLUMN spare_change BOOLEAN NOT NULL DEFAULT 0 CHECK (spare_change IN (0, 1));
+
+UPDATE available_subscriptions
+SET
+    spare_change = price & 1,
+    price = price >> 1;
+
+ALTER TABLE members
+ADD COLUMN spare_change BOOLEAN NOT NULL DEFAULT 0 CHECK (spare_change IN (0, 1));
+
+UPDATE members
+SET
+    spare_change = balance & 1,
+    balance = balance >> 1;
@@ -0,0 +1,18 @@
+-- Half-bobux balances
+-- depends: bobux-20261017_02_Hc8vN-vote-channel-checkpoints
+
+-- Balances and prices are stored as a single integer number of
+-- half-bobux instead of a whole amount plus a spare change flag.
+UPDATE members
+SET
+    balance = balance * 2 + spare_change;
+
+ALTER TABLE members
+DROP COLUMN spare_change;
+
+UPDATE available_subscriptions
+SET
+    price = price * 2 + spare_change;
+
+ALTER TABLE available_subscriptions
+DROP COLUMN spare_change;
@@ -0,0 +1,4 @@
+-- Leaderboard index
+-- depends: bobux-20261017_03_Zp6wE-half-bobux-balances
+
+DROP INDEX members_guild_id_balance_id;
@@ -0,0 +1,6 @@
+-- Leaderboard index
+-- depends: bobux-20261017_03_Zp6wE-half-bobux-balances
+
+-- Serves leaderboard pages and rank counts without sorting or scanning
+-- every member of the guild.
+CREATE INDEX members_guild_id_balance_id ON members (guild_id, balance DESC, id DESC);
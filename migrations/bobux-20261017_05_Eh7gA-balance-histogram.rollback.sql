@@ -0,0 +1,4 @@
+-- Balance histogram
+-- depends: bobux-20261017_04_Lb3kR-leaderboard-index
+
+DROP TABLE balance_histogram;
@@ -0,0 +1,15 @@
+-- Balance histogram
+-- depends: bobux-20261017_04_Lb3kR-leaderboard-index
+
+-- The number of accounts and their total balance in half-bobux, per
+-- guild and bucket of balances. Maintained by the bot alongside every
+-- balance change, and filled in the first time the bot starts after
+-- this migration.
+CREATE TABLE
+    balance_histogram (
+        guild_id INTEGER NOT NULL,
+        bucket INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        total INTEGER NOT NULL,
+        PRIMARY KEY (guild_id, bucket)
+    );
@@ -0,0 +1,4 @@
+-- Billing cycles
+-- depends: bobux-20261017_05_Eh7gA-balance-histogram
+
+DROP TABLE billing_cycles;
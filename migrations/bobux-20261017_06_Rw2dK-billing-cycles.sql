@@ -0,0 +1,12 @@
+-- Billing cycles
+-- depends: bobux-20261017_05_Eh7gA-balance-histogram
+
+-- The last weekly billing cycle that each guild's subscriptions were
+-- charged for, so that cycles missed while the bot was offline can be
+-- charged when it starts again. Guilds are added the first time the bot
+-- sees that they have subscriptions.
+CREATE TABLE
+    billing_cycles (
+        guild_id INTEGER NOT NULL PRIMARY KEY,
+        last_billed_cycle INTEGER NOT NULL
+    );
@@ -0,0 +1,5 @@
+-- Billing offsets
+-- depends: bobux-20261017_06_Rw2dK-billing-cycles
+
+ALTER TABLE guild_config
+DROP COLUMN billing_offset_minutes;
@@ -0,0 +1,8 @@
+-- Billing offsets
+-- depends: bobux-20261017_06_Rw2dK-billing-cycles
+
+-- When in each weekly billing cycle a guild is charged, in minutes after
+-- Monday midnight. Guilds without one get an offset derived from their
+-- ID.
+ALTER TABLE guild_config
+ADD COLUMN billing_offset_minutes INTEGER;
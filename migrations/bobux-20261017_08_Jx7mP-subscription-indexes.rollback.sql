@@ -0,0 +1,6 @@
+-- Subscription indexes
+-- depends: bobux-20261017_07_Tn5sB-billing-offsets
+
+DROP INDEX member_subscriptions_role_id;
+
+DROP INDEX available_subscriptions_guild_id;
@@ -0,0 +1,9 @@
+-- Subscription indexes
+-- depends: bobux-20261017_07_Tn5sB-billing-offsets
+
+-- Lookups by member, and by member and role, are already served by the
+-- primary key of member_subscriptions. These cover listing a guild's
+-- subscriptions and removing everyone from a deleted one.
+CREATE INDEX available_subscriptions_guild_id ON available_subscriptions (guild_id);
+
+CREATE INDEX member_subscriptions_role_id ON member_subscriptions (role_id);
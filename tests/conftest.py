@@ -0,0 +1,21 @@
+import contextlib
+import io
+from pathlib import Path
+
+import pytest
+import yoyo
+
+MIGRATIONS_PATH = Path(__file__).parent.parent / "migrations"
+
+
+@pytest.fixture
+def db_path(tmp_path: Path) -> str:
+    """A fresh database file with every migration applied."""
+
+    path = str(tmp_path / "bobux.db")
+    backend = yoyo.get_backend(f"sqlite:///{path}")
+    migrations = yoyo.read_migrations(str(MIGRATIONS_PATH))
+    # yoyo prints the results of any statement that returns rows.
+    with backend.lock(), contextlib.redirect_stdout(io.StringIO()):
+        backend.apply_migrations(backend.to_apply(migrations))
+    return path
@@ -0,0 +1,52 @@
+import asyncio
+
+from bobux_economy import database, economy, transactions
+from bobux_economy.bobux import Account, Bobux
+
+GUILD_ID = 1
+
+
+async def read_histogram(db_connection):
+    async with db_connection.execute(
+        "SELECT bucket, count, total FROM balance_histogram WHERE guild_id = ? ORDER BY bucket",
+        (GUILD_ID,),
+    ) as db_cursor:
+        return [tuple(row) for row in await db_cursor.fetchall()]
+
+
+def test_recompute_repairs_drift_from_reader_snapshot(db_path):
+    async def run():
+        db_connection = await database.connect_writer(db_path)
+        readers = database.ReaderPool(db_path, database.DatabaseSettings(reader_pool_size=1))
+        await readers.open()
+        database.attach_readers(db_connection, readers)
+        try:
+            for user_id, amount in enumerate([1, 5, 40, 300]):
+                await transactions.create_transaction(
+                    db_connection, None, Account(user_id, GUILD_ID), Bobux(amount)
+                )
+            expected = await read_histogram(db_connection)
+
+            # Balances written without going through transactions are
+            # missing from the histogram.
+            await db_connection.execute(
+                "INSERT INTO members VALUES (?, ?, ?)", (99, GUILD_ID, 80)
+            )
+            await db_connection.execute(
+                "DELETE FROM balance_histogram WHERE guild_id = ? AND bucket = ?",
+                (GUILD_ID, economy.bucket(2)),
+            )
+            await db_connection.commit()
+
+            assert await economy.recompute(db_connection) == 1
+            repaired = await read_histogram(db_connection)
+            assert (economy.bucket(80), 2, 160) in repaired
+            assert (economy.bucket(2), 1, 2) in repaired
+            assert len(repaired) == len(expected)
+
+            assert await economy.recompute(db_connection) == 0
+        finally:
+            await readers.close()
+            await db_connection.close()
+
+    asyncio.run(run())
@@ -0,0 +1,115 @@
+"""
+Checks that the billing and revocation statements use indexes, by running
+them against a small database, capturing the SQL that was executed, and
+reading its query plan.
+"""
+
+import asyncio
+from types import SimpleNamespace
+from typing import List
+
+from bobux_economy import database, subscriptions
+
+GUILD_ID = 1
+OTHER_GUILD_ID = 2
+ROLE_ID = 50
+MEMBER_ID = 1000
+BROKE_MEMBER_ID = 1001
+
+
+async def _populate(db_connection):
+    await db_connection.executemany(
+        "INSERT INTO available_subscriptions (role_id, guild_id, price) VALUES (?, ?, ?)",
+        [(ROLE_ID, GUILD_ID, 4), (ROLE_ID + 1, OTHER_GUILD_ID, 4)],
+    )
+    await db_connection.executemany(
+        "INSERT INTO member_subscriptions VALUES (?, ?, '2026-01-01 00:00:00')",
+        [(MEMBER_ID, ROLE_ID), (BROKE_MEMBER_ID, ROLE_ID), (MEMBER_ID, ROLE_ID + 1)],
+    )
+    await db_connection.executemany(
+        "INSERT INTO members (id, guild_id, balance) VALUES (?, ?, ?)",
+        [(MEMBER_ID, GUILD_ID, 100), (BROKE_MEMBER_ID, GUILD_ID, 1)],
+    )
+    await db_connection.executemany(
+        "INSERT INTO billing_cycles (guild_id, last_billed_cycle) VALUES (?, ?)",
+        [(GUILD_ID, 5), (OTHER_GUILD_ID, 5)],
+    )
+    await db_connection.commit()
+
+
+async def _query_plan(db_connection, sql: str) -> List[str]:
+    async with db_connection.execute(f"EXPLAIN QUERY PLAN {sql}") as db_cursor:
+        return [row["detail"] for row in await db_cursor.fetchall()]
+
+
+def _statement(statements: List[str], prefix: str) -> str:
+    matching = [sql for sql in statements if sql.strip().startswith(prefix)]
+    assert len(matching) == 1, f"expected one statement starting with {prefix!r}"
+    return matching[0].strip()
+
+
+def test_billing_and_revocation_use_indexes(db_path):
+    async def run():
+        db_connection = await database.connect_writer(db_path)
+        try:
+            await _populate(db_connection)
+
+            statements: List[str] = []
+            await db_connection.set_trace_callback(statements.append)
+            result = await subscriptions.charge(db_connection, {GUILD_ID: 6})
+            assert result.charged == 1
+            assert result.delinquent == [
+                subscriptions.Delinquency(BROKE_MEMBER_ID, ROLE_ID, GUILD_ID)
+            ]
+
+            async def remove_role(*args, **kwargs):
+                pass
+
+            bot = SimpleNamespace(
+                db_connection=db_connection,
+                http=SimpleNamespace(remove_role=remove_role),
+            )
+            assert await subscriptions.revoke(bot, result.delinquent) == 1
+            await db_connection.set_trace_callback(None)
+
+            # The temporary tables are dropped at the end of charge, so
+            # create them again to plan the statements that read them.
+            for prefix in (
+                "CREATE TEMP TABLE billing_due",
+                "INSERT INTO temp.billing_due",
+                "CREATE TEMP TABLE billing_run",
+            ):
+                await db_connection.execute(_statement(statements, prefix))
+
+            billing_run = _statement(statements, "CREATE TEMP TABLE billing_run")
+            billing_run_select = billing_run[billing_run.index("SELECT"):]
+            plans = {
+                "billing_run": await _query_plan(db_connection, billing_run_select),
+                "charge": await _query_plan(
+                    db_connection, _statement(statements, "UPDATE members")
+                ),
+                "revoke": await _query_plan(
+                    db_connection,
+                    _statement(statements, "DELETE FROM member_subscriptions"),
+                ),
+            }
+            await db_connection.rollback()
+        finally:
+            await db_connection.close()
+
+        # Only the subscriptions of the guilds that are due are read.
+        assert plans["billing_run"][1:5] == [
+            "SCAN temp.billing_due",
+            "SEARCH available_subscriptions USING INDEX available_subscriptions_guild_id (guild_id=?)",
+            "SEARCH member_subscriptions USING INDEX member_subscriptions_role_id (role_id=?)",
+            "SEARCH members USING INDEX sqlite_autoindex_members_1 (id=? AND guild_id=?) LEFT-JOIN",
+        ]
+        assert (
+            "SEARCH members USING INDEX sqlite_autoindex_members_1 (id=? AND guild_id=?)"
+            in plans["charge"]
+        )
+        assert plans["revoke"] == [
+            "SEARCH member_subscriptions USING INDEX sqlite_autoindex_member_subscriptions_1 (member_id=? AND role_id=?)"
+        ]
+
+    asyncio.run(run())
@@ -0,0 +1,43 @@
+import asyncio
+from types import SimpleNamespace
+
+import disnake
+import pytest
+
+from bobux_economy import database, subscriptions, transactions
+from bobux_economy.bobux import Account, Bobux
+
+GUILD_ID = 1
+MEMBER_ID = 1000
+ROLE_ID = 50
+
+
+class FakeMember:
+    id = MEMBER_ID
+    guild = SimpleNamespace(id=GUILD_ID)
+
+    async def add_roles(self, role, reason=None):
+        raise disnake.Forbidden(SimpleNamespace(status=403, reason="Forbidden"), "Missing Permissions")
+
+
+def test_subscribe_refunds_when_role_cannot_be_added(db_path):
+    async def run():
+        db_connection = await database.connect_writer(db_path)
+        try:
+            account = Account(MEMBER_ID, GUILD_ID)
+            await transactions.create_transaction(db_connection, None, account, Bobux(10))
+
+            with pytest.raises(disnake.Forbidden):
+                await subscriptions.subscribe(
+                    db_connection, FakeMember(), disnake.Object(ROLE_ID), Bobux(3)
+                )
+
+            assert await account.get_balance(db_connection) == Bobux(10)
+            async with db_connection.execute(
+                "SELECT * FROM member_subscriptions WHERE member_id = ?", (MEMBER_ID,)
+            ) as db_cursor:
+                assert await db_cursor.fetchone() is None
+        finally:
+            await db_connection.close()
+
+    asyncio.run(run())
@@ -0,0 +1,113 @@
+import asyncio
+from types import SimpleNamespace
+
+import disnake
+
+from bobux_economy import database, upvotes
+from bobux_economy.bobux import Account, Bobux
+from bobux_economy.group_commit import GroupCommit
+from bobux_economy.members import MemberResolver
+from bobux_economy.message_cache import MessageInfo
+from bobux_economy.upvotes import ReactionEvent, Vote, VoteTarget
+from bobux_economy.vote_dispatcher import VoteDispatcher
+
+GUILD_ID = 1
+CHANNEL_ID = 10
+MESSAGE_ID = 100
+POSTER_ID = 1000
+VOTER_ID = 2000
+
+
+class FakePartialMessage:
+    id = MESSAGE_ID
+
+    async def remove_reaction(self, emoji, member):
+        pass
+
+
+def make_bot(db_connection):
+    poster = SimpleNamespace(id=POSTER_ID)
+    guild = SimpleNamespace(
+        id=GUILD_ID,
+        get_member=lambda member_id: poster if member_id == POSTER_ID else None,
+    )
+    poster.guild = guild
+    bot = SimpleNamespace(
+        db_connection=db_connection,
+        group_commit=GroupCommit(db_connection, window=0),
+        members=MemberResolver(),
+    )
+    return bot, guild
+
+
+async def dispatch(dispatcher, target, event):
+    dispatcher.submit(target.key, target, event)
+    while len(dispatcher._workers) > 0:
+        await asyncio.sleep(0.01)
+
+
+async def fetch_one(db_connection, query, parameters=()):
+    async with db_connection.execute(query, parameters) as db_cursor:
+        return await db_cursor.fetchone()
+
+
+def test_removing_vote_after_poster_spent_reward(db_path):
+    async def run():
+        db_connection = await database.connect_writer(db_path)
+        try:
+            await db_connection.execute(
+                "INSERT INTO guild_config_vote_channel_ids VALUES (?, ?)",
+                (GUILD_ID, CHANNEL_ID),
+            )
+            await db_connection.commit()
+
+            bot, guild = make_bot(db_connection)
+            dispatcher = VoteDispatcher(
+                lambda target, events: upvotes.apply_reaction_events(
+                    bot, target, events
+                ),
+                coalesce_delay=0,
+            )
+            target = VoteTarget(
+                MessageInfo(MESSAGE_ID, CHANNEL_ID, GUILD_ID, POSTER_ID, None, False),
+                FakePartialMessage(),
+                guild,
+                disnake.Object(VOTER_ID),
+            )
+
+            await dispatch(dispatcher, target, ReactionEvent(Vote.UPVOTE, added=True))
+            poster = Account(POSTER_ID, GUILD_ID)
+            assert await poster.get_balance(db_connection) == upvotes.POSTER_REWARD
+
+            # The poster spends most of the reward before the vote is
+            # taken back.
+            await db_connection.execute(
+                "UPDATE members SET balance = 1 WHERE id = ?", (POSTER_ID,)
+            )
+            await db_connection.commit()
+
+            await dispatch(dispatcher, target, ReactionEvent(Vote.UPVOTE, added=False))
+
+            vote_row = await fetch_one(
+                db_connection, "SELECT * FROM votes WHERE message_id = ?", (MESSAGE_ID,)
+            )
+            assert vote_row is None
+
+            scores = await fetch_one(
+                db_connection,
+                "SELECT upvotes, score FROM message_scores WHERE message_id = ?",
+                (MESSAGE_ID,),
+            )
+            assert scores is not None
+            assert (scores["upvotes"], scores["score"]) == (0, 0)
+
+            balance = await fetch_one(
+                db_connection, "SELECT balance FROM members WHERE id = ?", (POSTER_ID,)
+            )
+            assert Bobux.from_halves(balance["balance"]) == (
+                Bobux.from_halves(1) - upvotes.POSTER_REWARD
+            )
+        finally:
+            await db_connection.close()
+
+    asyncio.run(run())
@@ -0,0 +1,29 @@
+import asyncio
+from types import SimpleNamespace
+
+from bobux_economy import database, vote_sync
+
+GUILD_ID = 1
+
+
+def test_vote_channels_without_checkpoints_are_synchronized(db_path):
+    async def run():
+        db_connection = await database.connect_writer(db_path)
+        try:
+            await db_connection.executemany(
+                "INSERT INTO guild_config_vote_channel_ids VALUES (?, ?)",
+                [(GUILD_ID, 10), (GUILD_ID, 20)],
+            )
+            await db_connection.execute(
+                "INSERT INTO vote_channel_checkpoints VALUES (?, ?, ?)",
+                (10, GUILD_ID, 500),
+            )
+            await db_connection.commit()
+
+            bot = SimpleNamespace(db_connection=db_connection)
+            vote_channels = await vote_sync._get_vote_channels(bot)
+            assert sorted(vote_channels) == [(GUILD_ID, 10, 500), (GUILD_ID, 20, None)]
+        finally:
+            await db_connection.close()
+
+    asyncio.run(run())